@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 import os
+import queue
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 import pymysql
-from prometheus_client import start_http_server, Gauge, Counter, Info
+from prometheus_client import start_http_server, Gauge, Counter, Info, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
 
 # Database configuration from environment
 DB_HOST = os.getenv('DB_HOST', 'mariadb')
@@ -13,77 +19,151 @@ DB_USER = os.getenv('DB_USER', 'booklore')
 DB_PASSWORD = os.getenv('DB_PASSWORD', '')
 EXPORTER_PORT = int(os.getenv('EXPORTER_PORT', 9090))
 SCRAPE_INTERVAL = int(os.getenv('SCRAPE_INTERVAL', 60))
+# Collection jobs run concurrently on up to this many MariaDB connections
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 4))
+
+# Collection jobs are refreshed by cost class: cheap ones every SCRAPE_INTERVAL,
+# the rest less often. At most EXPENSIVE_JOBS_PER_CYCLE expensive jobs start in
+# one cycle (after the first), so they spread out instead of landing together.
+COST_INTERVALS = {
+    'cheap': SCRAPE_INTERVAL,
+    'moderate': int(os.getenv('MODERATE_REFRESH_INTERVAL', 300)),
+    'expensive': int(os.getenv('EXPENSIVE_REFRESH_INTERVAL', 3600)),
+}
+EXPENSIVE_JOBS_PER_CYCLE = int(os.getenv('EXPENSIVE_JOBS_PER_CYCLE', 1))
+# Per-job overrides as "job=seconds,..." (job = collect_* function name without the prefix)
+REFRESH_INTERVALS = {
+    name.strip(): int(seconds)
+    for name, seconds in (item.split('=') for item in os.getenv('REFRESH_INTERVALS', '').split(',') if item.strip())
+}
+
+# reading_sessions rollups are rebuilt from scratch this often (seconds)
+ROLLUP_RECONCILE_INTERVAL = int(os.getenv('ROLLUP_RECONCILE_INTERVAL', 21600))
+# Rows per query when folding new reading_sessions into the rollups
+ROLLUP_BATCH_SIZE = 10000
+
+
+# =============================================================================
+# SNAPSHOT
+# =============================================================================
+# BookLore gauges are not live prometheus_client Gauges: each collection cycle
+# builds a complete set of metric families and swaps it in as one immutable
+# tuple, so a scrape during a cycle still sees the whole previous snapshot.
+
+class SnapshotGauge:
+    """Name, help and labels of a gauge served from the snapshot"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        snapshot.gauges.append(self)
+
+    def family(self, samples):
+        """GaugeMetricFamily of (labels, value) samples; a repeated label set keeps its last value"""
+        series = {}
+        for labels, value in samples:
+            series[tuple(str(labels[name]) for name in self.labelnames)] = float(value)
+        family = GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+        for label_values, value in series.items():
+            family.add_metric(label_values, value)
+        return family
+
+
+class SnapshotCollector:
+    """Serves the last published snapshot; scrapes never wait on the database"""
+
+    def __init__(self):
+        self.gauges = []
+        # Family of each gauge from its last successful collection
+        self.families = {}
+        self.snapshot = ()
+
+    def describe(self):
+        return [GaugeMetricFamily(gauge.name, gauge.documentation, labels=gauge.labelnames) for gauge in self.gauges]
+
+    def collect(self):
+        return self.snapshot
+
+    def publish(self, families):
+        """Replace the families of the gauges in [(gauge, family)] and swap in a new snapshot"""
+        for gauge, family in families:
+            self.families[gauge] = family
+        self.snapshot = tuple(self.families[gauge] for gauge in self.gauges if gauge in self.families)
+
+
+snapshot = SnapshotCollector()
 
 # =============================================================================
 # LIBRARY METRICS
 # =============================================================================
-booklore_books_total = Gauge('booklore_books_total', 'Total number of books', ['library', 'read_status'])
-booklore_users_total = Gauge('booklore_users_total', 'Total number of users')
-booklore_libraries_total = Gauge('booklore_libraries_total', 'Total number of libraries')
-booklore_authors_total = Gauge('booklore_authors_total', 'Total number of authors')
-booklore_shelves_total = Gauge('booklore_shelves_total', 'Total number of shelves')
-booklore_categories_total = Gauge('booklore_categories_total', 'Total number of categories')
-booklore_books_by_type = Gauge('booklore_books_by_type', 'Number of books by file type', ['file_type'])
-booklore_books_by_category = Gauge('booklore_books_by_category', 'Number of books by category', ['category'])
-booklore_books_by_author = Gauge('booklore_books_by_author', 'Number of books by author', ['author'])
-booklore_books_with_series = Gauge('booklore_books_with_series', 'Number of books that are part of a series')
-booklore_series_total = Gauge('booklore_series_total', 'Total number of unique series')
+booklore_books_total = SnapshotGauge('booklore_books_total', 'Total number of books', ['library', 'read_status'])
+booklore_users_total = SnapshotGauge('booklore_users_total', 'Total number of users')
+booklore_libraries_total = SnapshotGauge('booklore_libraries_total', 'Total number of libraries')
+booklore_authors_total = SnapshotGauge('booklore_authors_total', 'Total number of authors')
+booklore_shelves_total = SnapshotGauge('booklore_shelves_total', 'Total number of shelves')
+booklore_categories_total = SnapshotGauge('booklore_categories_total', 'Total number of categories')
+booklore_books_by_type = SnapshotGauge('booklore_books_by_type', 'Number of books by file type', ['file_type'])
+booklore_books_by_category = SnapshotGauge('booklore_books_by_category', 'Number of books by category', ['category'])
+booklore_books_by_author = SnapshotGauge('booklore_books_by_author', 'Number of books by author', ['author'])
+booklore_books_with_series = SnapshotGauge('booklore_books_with_series', 'Number of books that are part of a series')
+booklore_series_total = SnapshotGauge('booklore_series_total', 'Total number of unique series')
 
 # =============================================================================
 # USER READING STATUS METRICS
 # =============================================================================
-booklore_user_books_by_status = Gauge('booklore_user_books_by_status', 'Books by read status per user', ['user', 'status'])
-booklore_user_books_with_progress = Gauge('booklore_user_books_with_progress', 'Books with reading progress', ['user'])
-booklore_user_books_finished = Gauge('booklore_user_books_finished', 'Number of finished books', ['user'])
-booklore_user_average_progress = Gauge('booklore_user_average_progress_percent', 'Average reading progress percentage', ['user'])
-booklore_user_books_rated = Gauge('booklore_user_books_rated', 'Number of books rated by user', ['user'])
-booklore_user_average_rating = Gauge('booklore_user_average_rating', 'Average book rating by user', ['user'])
-booklore_user_books_by_progress_range = Gauge('booklore_user_books_by_progress_range', 'Books by reading progress range', ['user', 'progress_range'])
-booklore_user_books_by_rating = Gauge('booklore_user_books_by_rating', 'Books by personal rating', ['user', 'rating'])
-booklore_reading_time_by_category = Gauge('booklore_reading_time_by_category_seconds', 'Reading time by category/genre in seconds', ['user', 'category'])
+booklore_user_books_by_status = SnapshotGauge('booklore_user_books_by_status', 'Books by read status per user', ['user', 'status'])
+booklore_user_books_with_progress = SnapshotGauge('booklore_user_books_with_progress', 'Books with reading progress', ['user'])
+booklore_user_books_finished = SnapshotGauge('booklore_user_books_finished', 'Number of finished books', ['user'])
+booklore_user_average_progress = SnapshotGauge('booklore_user_average_progress_percent', 'Average reading progress percentage', ['user'])
+booklore_user_books_rated = SnapshotGauge('booklore_user_books_rated', 'Number of books rated by user', ['user'])
+booklore_user_average_rating = SnapshotGauge('booklore_user_average_rating', 'Average book rating by user', ['user'])
+booklore_user_books_by_progress_range = SnapshotGauge('booklore_user_books_by_progress_range', 'Books by reading progress range', ['user', 'progress_range'])
+booklore_user_books_by_rating = SnapshotGauge('booklore_user_books_by_rating', 'Books by personal rating', ['user', 'rating'])
+booklore_reading_time_by_category = SnapshotGauge('booklore_reading_time_by_category_seconds', 'Reading time by category/genre in seconds', ['user', 'category'])
 
 # =============================================================================
 # READING SESSION METRICS
 # =============================================================================
-booklore_reading_sessions_total = Gauge('booklore_reading_sessions_total', 'Total number of reading sessions')
-booklore_reading_time_total_seconds = Gauge('booklore_reading_time_total_seconds', 'Total reading time in seconds', ['user'])
-booklore_reading_sessions_by_date = Gauge('booklore_reading_sessions_by_date', 'Reading sessions by date', ['user', 'date'])
-booklore_reading_time_by_date = Gauge('booklore_reading_time_by_date_seconds', 'Reading time by date in seconds', ['user', 'date'])
-booklore_reading_progress_by_date = Gauge('booklore_reading_progress_by_date', 'Reading progress delta by date', ['user', 'date'])
-booklore_reading_sessions_by_book_type = Gauge('booklore_reading_sessions_by_book_type', 'Reading sessions by book type', ['user', 'book_type'])
-booklore_reading_time_by_book_type = Gauge('booklore_reading_time_by_book_type_seconds', 'Reading time by book type', ['user', 'book_type'])
+booklore_reading_sessions_total = SnapshotGauge('booklore_reading_sessions_total', 'Total number of reading sessions')
+booklore_reading_time_total_seconds = SnapshotGauge('booklore_reading_time_total_seconds', 'Total reading time in seconds', ['user'])
+booklore_reading_sessions_by_date = SnapshotGauge('booklore_reading_sessions_by_date', 'Reading sessions by date', ['user', 'date'])
+booklore_reading_time_by_date = SnapshotGauge('booklore_reading_time_by_date_seconds', 'Reading time by date in seconds', ['user', 'date'])
+booklore_reading_progress_by_date = SnapshotGauge('booklore_reading_progress_by_date', 'Reading progress delta by date', ['user', 'date'])
+booklore_reading_sessions_by_book_type = SnapshotGauge('booklore_reading_sessions_by_book_type', 'Reading sessions by book type', ['user', 'book_type'])
+booklore_reading_time_by_book_type = SnapshotGauge('booklore_reading_time_by_book_type_seconds', 'Reading time by book type', ['user', 'book_type'])
 
 # =============================================================================
 # READING STREAKS AND HABITS
 # =============================================================================
-booklore_current_reading_streak_days = Gauge('booklore_current_reading_streak_days', 'Current consecutive days reading streak', ['user'])
-booklore_longest_reading_streak_days = Gauge('booklore_longest_reading_streak_days', 'Longest reading streak in days', ['user'])
-booklore_days_read_this_month = Gauge('booklore_days_read_this_month', 'Number of days read this month', ['user'])
-booklore_days_read_this_year = Gauge('booklore_days_read_this_year', 'Number of days read this year', ['user'])
-booklore_average_session_duration_seconds = Gauge('booklore_average_session_duration_seconds', 'Average reading session duration', ['user'])
-booklore_reading_sessions_by_hour = Gauge('booklore_reading_sessions_by_hour', 'Reading sessions by hour of day', ['user', 'hour'])
-booklore_reading_sessions_by_weekday = Gauge('booklore_reading_sessions_by_weekday', 'Reading sessions by day of week', ['user', 'weekday'])
+booklore_current_reading_streak_days = SnapshotGauge('booklore_current_reading_streak_days', 'Current consecutive days reading streak', ['user'])
+booklore_longest_reading_streak_days = SnapshotGauge('booklore_longest_reading_streak_days', 'Longest reading streak in days', ['user'])
+booklore_days_read_this_month = SnapshotGauge('booklore_days_read_this_month', 'Number of days read this month', ['user'])
+booklore_days_read_this_year = SnapshotGauge('booklore_days_read_this_year', 'Number of days read this year', ['user'])
+booklore_average_session_duration_seconds = SnapshotGauge('booklore_average_session_duration_seconds', 'Average reading session duration', ['user'])
+booklore_reading_sessions_by_hour = SnapshotGauge('booklore_reading_sessions_by_hour', 'Reading sessions by hour of day', ['user', 'hour'])
+booklore_reading_sessions_by_weekday = SnapshotGauge('booklore_reading_sessions_by_weekday', 'Reading sessions by day of week', ['user', 'weekday'])
 
 # =============================================================================
 # BOOKS FINISHED OVER TIME
 # =============================================================================
-booklore_books_finished_by_month = Gauge('booklore_books_finished_by_month', 'Books finished by month', ['user', 'ym'])
-booklore_books_finished_this_year = Gauge('booklore_books_finished_this_year', 'Books finished this year', ['user'])
-booklore_books_finished_this_month = Gauge('booklore_books_finished_this_month', 'Books finished this month', ['user'])
+booklore_books_finished_by_month = SnapshotGauge('booklore_books_finished_by_month', 'Books finished by month', ['user', 'ym'])
+booklore_books_finished_this_year = SnapshotGauge('booklore_books_finished_this_year', 'Books finished this year', ['user'])
+booklore_books_finished_this_month = SnapshotGauge('booklore_books_finished_this_month', 'Books finished this month', ['user'])
 
 # =============================================================================
 # RECENT ACTIVITY
 # =============================================================================
-booklore_last_read_timestamp = Gauge('booklore_last_read_timestamp', 'Timestamp of last reading activity', ['user'])
-booklore_books_read_last_7_days = Gauge('booklore_books_read_last_7_days', 'Unique books read in last 7 days', ['user'])
-booklore_reading_time_last_7_days_seconds = Gauge('booklore_reading_time_last_7_days_seconds', 'Reading time in last 7 days', ['user'])
-booklore_reading_time_last_30_days_seconds = Gauge('booklore_reading_time_last_30_days_seconds', 'Reading time in last 30 days', ['user'])
+booklore_last_read_timestamp = SnapshotGauge('booklore_last_read_timestamp', 'Timestamp of last reading activity', ['user'])
+booklore_books_read_last_7_days = SnapshotGauge('booklore_books_read_last_7_days', 'Unique books read in last 7 days', ['user'])
+booklore_reading_time_last_7_days_seconds = SnapshotGauge('booklore_reading_time_last_7_days_seconds', 'Reading time in last 7 days', ['user'])
+booklore_reading_time_last_30_days_seconds = SnapshotGauge('booklore_reading_time_last_30_days_seconds', 'Reading time in last 30 days', ['user'])
 
 # =============================================================================
 # KOREADER SYNC METRICS
 # =============================================================================
-booklore_koreader_synced_books = Gauge('booklore_koreader_synced_books', 'Books synced with KOReader', ['user', 'device'])
-booklore_koreader_last_sync_timestamp = Gauge('booklore_koreader_last_sync_timestamp', 'Last KOReader sync timestamp', ['user'])
+booklore_koreader_synced_books = SnapshotGauge('booklore_koreader_synced_books', 'Books synced with KOReader', ['user', 'device'])
+booklore_koreader_last_sync_timestamp = SnapshotGauge('booklore_koreader_last_sync_timestamp', 'Last KOReader sync timestamp', ['user'])
 
 # =============================================================================
 # SCRAPE METRICS
@@ -91,6 +171,9 @@ booklore_koreader_last_sync_timestamp = Gauge('booklore_koreader_last_sync_times
 booklore_last_scrape = Gauge('booklore_last_scrape_timestamp', 'Timestamp of last successful scrape')
 booklore_scrape_errors = Counter('booklore_scrape_errors_total', 'Total number of scrape errors')
 booklore_scrape_duration = Gauge('booklore_scrape_duration_seconds', 'Duration of last scrape')
+booklore_job_last_success = SnapshotGauge('booklore_collection_job_last_success_timestamp', 'Timestamp of the last successful run of a collection job', ['job'])
+
+REGISTRY.register(snapshot)
 
 
 def get_db_connection():
@@ -100,525 +183,701 @@ def get_db_connection():
         user=DB_USER,
         password=DB_PASSWORD,
         database=DB_NAME,
-        cursorclass=pymysql.cursors.DictCursor
+        cursorclass=pymysql.cursors.DictCursor,
+        # Pooled connections outlive a scrape; autocommit keeps each query off a stale snapshot
+        autocommit=True
     )
 
 
-def clear_gauge_metrics(gauge):
-    """Clear all label combinations for a gauge"""
-    gauge._metrics.clear()
+class ConnectionPool:
+    """MariaDB connections opened on demand and reused across scrapes"""
+
+    def __init__(self):
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = get_db_connection()
+        try:
+            conn.ping(reconnect=True)
+            yield conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        self.idle.put(conn)
+
+
+# At most DB_POOL_SIZE jobs run at once, so the pool never holds more connections
+db_pool = ConnectionPool()
+executor = ThreadPoolExecutor(DB_POOL_SIZE, thread_name_prefix='collect')
+
+
+def current_streak(read_dates, today):
+    """Consecutive reading days ending today or yesterday; read_dates newest first"""
+    streak = 0
+    expected_date = today
+    for read_date in read_dates:
+        if read_date == expected_date or read_date == expected_date - timedelta(days=1):
+            streak += 1
+            expected_date = read_date - timedelta(days=1)
+        else:
+            break
+    return streak
+
+
+def longest_streak(read_dates):
+    """Longest run of consecutive reading days; read_dates newest first"""
+    if not read_dates:
+        return 0
+    longest = 0
+    streak = 1
+    read_dates_asc = read_dates[::-1]
+    for i in range(1, len(read_dates_asc)):
+        if read_dates_asc[i] - read_dates_asc[i-1] == timedelta(days=1):
+            streak += 1
+        else:
+            longest = max(longest, streak)
+            streak = 1
+    return max(longest, streak)
 
 
-def collect_metrics():
-    start_time = time.time()
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # =====================================================================
-        # LIBRARY METRICS
-        # =====================================================================
-
-        # Books by library and read status
-        cursor.execute("""
-            SELECT l.name as library, COALESCE(b.read_status, 'UNREAD') as read_status, COUNT(*) as count
-            FROM book b
-            JOIN library l ON b.library_id = l.id
-            WHERE b.deleted = 0
-            GROUP BY l.name, b.read_status
-        """)
-        clear_gauge_metrics(booklore_books_total)
-        for row in cursor.fetchall():
-            booklore_books_total.labels(library=row['library'], read_status=row['read_status']).set(row['count'])
-
-        # Total users
-        cursor.execute("SELECT COUNT(*) as count FROM users")
-        booklore_users_total.set(cursor.fetchone()['count'])
-
-        # Total libraries
-        cursor.execute("SELECT COUNT(*) as count FROM library")
-        booklore_libraries_total.set(cursor.fetchone()['count'])
-
-        # Total authors
-        cursor.execute("SELECT COUNT(*) as count FROM author")
-        booklore_authors_total.set(cursor.fetchone()['count'])
-
-        # Total shelves
-        cursor.execute("SELECT COUNT(*) as count FROM shelf")
-        booklore_shelves_total.set(cursor.fetchone()['count'])
-
-        # Total categories
-        cursor.execute("SELECT COUNT(*) as count FROM category")
-        booklore_categories_total.set(cursor.fetchone()['count'])
-
-        # Books by file type
-        cursor.execute("""
-            SELECT UPPER(SUBSTRING_INDEX(file_name, '.', -1)) as file_type, COUNT(DISTINCT book_id) as count
-            FROM book_file
-            GROUP BY file_type
-        """)
-        clear_gauge_metrics(booklore_books_by_type)
-        for row in cursor.fetchall():
-            booklore_books_by_type.labels(file_type=row['file_type']).set(row['count'])
-
-        # Books by category (top 20)
-        cursor.execute("""
-            SELECT c.name, COUNT(DISTINCT bcm.book_id) as book_count
-            FROM category c
-            JOIN book_metadata_category_mapping bcm ON c.id = bcm.category_id
-            GROUP BY c.id, c.name
-            ORDER BY book_count DESC
-            LIMIT 20
-        """)
-        clear_gauge_metrics(booklore_books_by_category)
-        for row in cursor.fetchall():
-            booklore_books_by_category.labels(category=row['name']).set(row['book_count'])
-
-        # Books by author (top 20)
-        cursor.execute("""
-            SELECT a.name, COUNT(DISTINCT bam.book_id) as book_count
-            FROM author a
-            JOIN book_metadata_author_mapping bam ON a.id = bam.author_id
-            GROUP BY a.id, a.name
-            ORDER BY book_count DESC
-            LIMIT 20
-        """)
-        clear_gauge_metrics(booklore_books_by_author)
-        for row in cursor.fetchall():
-            booklore_books_by_author.labels(author=row['name']).set(row['book_count'])
-
-        # Series metrics
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM book_metadata WHERE series_name IS NOT NULL AND series_name != ''
-        """)
-        booklore_books_with_series.set(cursor.fetchone()['count'])
-
-        cursor.execute("""
-            SELECT COUNT(DISTINCT series_name) as count FROM book_metadata WHERE series_name IS NOT NULL AND series_name != ''
-        """)
-        booklore_series_total.set(cursor.fetchone()['count'])
-
-        # =====================================================================
-        # USER READING STATUS METRICS
-        # =====================================================================
-
-        # Books by read status per user
-        cursor.execute("""
-            SELECT u.username, COALESCE(ubp.read_status, 'NONE') as status, COUNT(*) as count
-            FROM users u
-            LEFT JOIN user_book_progress ubp ON u.id = ubp.user_id
-            GROUP BY u.id, u.username, ubp.read_status
-        """)
-        clear_gauge_metrics(booklore_user_books_by_status)
-        for row in cursor.fetchall():
-            if row['status']:
-                booklore_user_books_by_status.labels(user=row['username'], status=row['status']).set(row['count'])
-
-        # Books with progress
-        cursor.execute("""
-            SELECT u.username, COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE COALESCE(ubp.pdf_progress_percent, ubp.epub_progress_percent, ubp.cbx_progress_percent, ubp.koreader_progress_percent, 0) > 0
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_user_books_with_progress)
-        for row in cursor.fetchall():
-            booklore_user_books_with_progress.labels(user=row['username']).set(row['count'])
-
-        # Books finished per user
-        cursor.execute("""
-            SELECT u.username, COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.read_status = 'READ'
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_user_books_finished)
-        for row in cursor.fetchall():
-            booklore_user_books_finished.labels(user=row['username']).set(row['count'])
-
-        # Average progress per user
-        cursor.execute("""
-            SELECT u.username,
-                   AVG(GREATEST(
-                       COALESCE(ubp.pdf_progress_percent, 0),
-                       COALESCE(ubp.epub_progress_percent, 0),
-                       COALESCE(ubp.cbx_progress_percent, 0),
-                       COALESCE(ubp.koreader_progress_percent, 0)
-                   )) as avg_progress
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_user_average_progress)
-        for row in cursor.fetchall():
-            if row['avg_progress'] is not None:
-                booklore_user_average_progress.labels(user=row['username']).set(row['avg_progress'])
-
-        # Books rated
-        cursor.execute("""
-            SELECT u.username, COUNT(*) as count, AVG(ubp.personal_rating) as avg_rating
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.personal_rating IS NOT NULL
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_user_books_rated)
-        clear_gauge_metrics(booklore_user_average_rating)
-        for row in cursor.fetchall():
-            booklore_user_books_rated.labels(user=row['username']).set(row['count'])
-            if row['avg_rating']:
-                booklore_user_average_rating.labels(user=row['username']).set(row['avg_rating'])
-
-        # Books by progress range
-        cursor.execute("""
-            SELECT u.username,
-                   CASE
-                       WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) = 0 THEN '0%'
-                       WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) <= 0.25 THEN '1-25%'
-                       WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) <= 0.50 THEN '26-50%'
-                       WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) <= 0.75 THEN '51-75%'
-                       WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) < 1.0 THEN '76-99%'
-                       ELSE '100%'
-                   END as progress_range,
-                   COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            GROUP BY u.id, u.username, progress_range
-        """)
-        clear_gauge_metrics(booklore_user_books_by_progress_range)
-        for row in cursor.fetchall():
-            booklore_user_books_by_progress_range.labels(user=row['username'], progress_range=row['progress_range']).set(row['count'])
-
-        # Books by personal rating
-        cursor.execute("""
-            SELECT u.username, ubp.personal_rating as rating, COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.personal_rating IS NOT NULL
-            GROUP BY u.id, u.username, ubp.personal_rating
-        """)
-        clear_gauge_metrics(booklore_user_books_by_rating)
-        for row in cursor.fetchall():
-            booklore_user_books_by_rating.labels(user=row['username'], rating=str(row['rating'])).set(row['count'])
-
-        # =====================================================================
-        # READING SESSION METRICS
-        # =====================================================================
-
-        # Total reading sessions
-        cursor.execute("SELECT COUNT(*) as count FROM reading_sessions")
-        booklore_reading_sessions_total.set(cursor.fetchone()['count'])
-
-        # Total reading time per user
-        cursor.execute("""
-            SELECT u.username, COALESCE(SUM(rs.duration_seconds), 0) as total_seconds
-            FROM users u
-            LEFT JOIN reading_sessions rs ON u.id = rs.user_id
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_reading_time_total_seconds)
-        for row in cursor.fetchall():
-            booklore_reading_time_total_seconds.labels(user=row['username']).set(row['total_seconds'])
-
-        # Reading sessions by date (last 30 days)
-        cursor.execute("""
-            SELECT u.username, DATE(rs.start_time) as date,
-                   COUNT(*) as sessions,
-                   SUM(rs.duration_seconds) as total_seconds,
-                   SUM(rs.progress_delta) as total_progress
-            FROM users u
-            JOIN reading_sessions rs ON u.id = rs.user_id
-            WHERE rs.start_time >= DATE_SUB(CURDATE(), INTERVAL 30 DAY)
-            GROUP BY u.id, u.username, DATE(rs.start_time)
-        """)
-        clear_gauge_metrics(booklore_reading_sessions_by_date)
-        clear_gauge_metrics(booklore_reading_time_by_date)
-        clear_gauge_metrics(booklore_reading_progress_by_date)
-        for row in cursor.fetchall():
-            date_str = row['date'].strftime('%Y-%m-%d')
-            booklore_reading_sessions_by_date.labels(user=row['username'], date=date_str).set(row['sessions'])
-            booklore_reading_time_by_date.labels(user=row['username'], date=date_str).set(row['total_seconds'])
-            booklore_reading_progress_by_date.labels(user=row['username'], date=date_str).set(row['total_progress'] or 0)
-
-        # Reading sessions by book type
-        cursor.execute("""
-            SELECT u.username, rs.book_type, COUNT(*) as sessions, SUM(rs.duration_seconds) as total_seconds
-            FROM users u
-            JOIN reading_sessions rs ON u.id = rs.user_id
-            GROUP BY u.id, u.username, rs.book_type
-        """)
-        clear_gauge_metrics(booklore_reading_sessions_by_book_type)
-        clear_gauge_metrics(booklore_reading_time_by_book_type)
-        for row in cursor.fetchall():
-            booklore_reading_sessions_by_book_type.labels(user=row['username'], book_type=row['book_type']).set(row['sessions'])
-            booklore_reading_time_by_book_type.labels(user=row['username'], book_type=row['book_type']).set(row['total_seconds'])
-
-        # Reading time by category/genre (top 15)
-        cursor.execute("""
-            SELECT u.username, c.name as category, SUM(rs.duration_seconds) as total_seconds
-            FROM users u
-            JOIN reading_sessions rs ON u.id = rs.user_id
-            JOIN book b ON rs.book_id = b.id
-            JOIN book_metadata bm ON b.id = bm.book_id
-            JOIN book_metadata_category_mapping bcm ON bm.book_id = bcm.book_id
-            JOIN category c ON bcm.category_id = c.id
-            GROUP BY u.id, u.username, c.name
-            ORDER BY total_seconds DESC
-            LIMIT 15
-        """)
-        clear_gauge_metrics(booklore_reading_time_by_category)
-        for row in cursor.fetchall():
-            booklore_reading_time_by_category.labels(user=row['username'], category=row['category']).set(row['total_seconds'])
-
-        # =====================================================================
-        # READING STREAKS AND HABITS
-        # =====================================================================
-
-        # Get users for streak calculation
-        cursor.execute("SELECT id, username FROM users")
-        users = cursor.fetchall()
-
-        clear_gauge_metrics(booklore_current_reading_streak_days)
-        clear_gauge_metrics(booklore_longest_reading_streak_days)
-        clear_gauge_metrics(booklore_days_read_this_month)
-        clear_gauge_metrics(booklore_days_read_this_year)
-        clear_gauge_metrics(booklore_average_session_duration_seconds)
-
-        for user in users:
-            # Get distinct reading days ordered
-            cursor.execute("""
-                SELECT DISTINCT DATE(start_time) as read_date
-                FROM reading_sessions
-                WHERE user_id = %s
-                ORDER BY read_date DESC
-            """, (user['id'],))
-            read_dates = [row['read_date'] for row in cursor.fetchall()]
-
-            # Calculate current streak
-            current_streak = 0
-            if read_dates:
-                today = datetime.now().date()
-                expected_date = today
-                for read_date in read_dates:
-                    if read_date == expected_date or read_date == expected_date - timedelta(days=1):
-                        current_streak += 1
-                        expected_date = read_date - timedelta(days=1)
-                    else:
-                        break
-
-            booklore_current_reading_streak_days.labels(user=user['username']).set(current_streak)
-
-            # Calculate longest streak
-            longest_streak = 0
-            if read_dates:
-                read_dates_asc = sorted(read_dates)
-                streak = 1
-                for i in range(1, len(read_dates_asc)):
-                    if read_dates_asc[i] - read_dates_asc[i-1] == timedelta(days=1):
-                        streak += 1
-                    else:
-                        longest_streak = max(longest_streak, streak)
-                        streak = 1
-                longest_streak = max(longest_streak, streak)
-
-            booklore_longest_reading_streak_days.labels(user=user['username']).set(longest_streak)
-
-            # Days read this month
+# =============================================================================
+# READING SESSION ROLLUPS
+# =============================================================================
+# reading_sessions is append-mostly (the sync bridge only inserts), so its
+# all-history aggregates are kept in memory per user and each cycle folds in
+# only the rows past the id watermark. A full rebuild every
+# ROLLUP_RECONCILE_INTERVAL picks up edits, deletes and ids committed late.
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+class UserRollup:
+    """Aggregates over one user's reading_sessions rows"""
+
+    def __init__(self):
+        self.sessions = 0
+        # Sum and count of the rows that have a duration (SUM/AVG skip NULLs)
+        self.seconds = 0
+        self.timed_sessions = 0
+        self.by_book_type = defaultdict(lambda: [0, 0])
+        self.by_hour = defaultdict(int)
+        self.by_weekday = defaultdict(int)
+        self.seconds_by_book = defaultdict(int)
+
+    def add(self, row):
+        seconds = row['duration_seconds']
+        start = row['start_time']
+        self.sessions += 1
+        self.by_book_type[row['book_type']][0] += 1
+        self.by_book_type[row['book_type']][1] += seconds or 0
+        self.by_hour[None if start is None else start.hour] += 1
+        self.by_weekday[None if start is None else WEEKDAYS[start.weekday()]] += 1
+        self.seconds_by_book[row['book_id']] += seconds or 0
+        if seconds is not None:
+            self.seconds += seconds
+            self.timed_sessions += 1
+
+
+class SessionRollups:
+    """UserRollup per user_id, up to reading_sessions.id last_id"""
+
+    def __init__(self):
+        self.users = {}
+        self.last_id = 0
+        self.reconciled_at = time.time()
+
+    def fold(self, cursor):
+        """Add the rows with id > last_id"""
+        while True:
             cursor.execute("""
-                SELECT COUNT(DISTINCT DATE(start_time)) as days
+                SELECT id, user_id, book_id, book_type, start_time, duration_seconds
                 FROM reading_sessions
-                WHERE user_id = %s AND YEAR(start_time) = YEAR(CURDATE()) AND MONTH(start_time) = MONTH(CURDATE())
-            """, (user['id'],))
-            result = cursor.fetchone()
-            booklore_days_read_this_month.labels(user=user['username']).set(result['days'] if result else 0)
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+            """, (self.last_id, ROLLUP_BATCH_SIZE))
+            rows = cursor.fetchall()
+            for row in rows:
+                rollup = self.users.get(row['user_id'])
+                if rollup is None:
+                    rollup = self.users[row['user_id']] = UserRollup()
+                rollup.add(row)
+            if rows:
+                self.last_id = rows[-1]['id']
+            if len(rows) < ROLLUP_BATCH_SIZE:
+                return
+
+
+# Built by the first collect_session_rollups
+session_rollups = None
+# book_id -> category names, reloaded by collect_session_rollups on the expensive schedule
+book_categories = None
+book_categories_loaded_at = 0
+
+
+def load_book_categories(cursor):
+    """book_id -> category names, one per category mapping as in the JOIN the category times used to come from"""
+    cursor.execute("""
+        SELECT bcm.book_id, c.name as category
+        FROM book b
+        JOIN book_metadata bm ON b.id = bm.book_id
+        JOIN book_metadata_category_mapping bcm ON bm.book_id = bcm.book_id
+        JOIN category c ON bcm.category_id = c.id
+    """)
+    categories = defaultdict(list)
+    for row in cursor.fetchall():
+        categories[row['book_id']].append(row['category'])
+    return categories
 
-            # Days read this year
-            cursor.execute("""
-                SELECT COUNT(DISTINCT DATE(start_time)) as days
-                FROM reading_sessions
-                WHERE user_id = %s AND YEAR(start_time) = YEAR(CURDATE())
-            """, (user['id'],))
-            result = cursor.fetchone()
-            booklore_days_read_this_year.labels(user=user['username']).set(result['days'] if result else 0)
 
-            # Average session duration
-            cursor.execute("""
-                SELECT AVG(duration_seconds) as avg_duration
-                FROM reading_sessions
-                WHERE user_id = %s
-            """, (user['id'],))
-            result = cursor.fetchone()
-            if result and result['avg_duration']:
-                booklore_average_session_duration_seconds.labels(user=user['username']).set(result['avg_duration'])
-
-        # Reading sessions by hour of day
-        cursor.execute("""
-            SELECT u.username, HOUR(rs.start_time) as hour, COUNT(*) as sessions
-            FROM users u
-            JOIN reading_sessions rs ON u.id = rs.user_id
-            GROUP BY u.id, u.username, HOUR(rs.start_time)
-        """)
-        clear_gauge_metrics(booklore_reading_sessions_by_hour)
-        for row in cursor.fetchall():
-            booklore_reading_sessions_by_hour.labels(user=row['username'], hour=str(row['hour']).zfill(2)).set(row['sessions'])
-
-        # Reading sessions by weekday
-        cursor.execute("""
-            SELECT u.username, DAYNAME(rs.start_time) as weekday, COUNT(*) as sessions
-            FROM users u
-            JOIN reading_sessions rs ON u.id = rs.user_id
-            GROUP BY u.id, u.username, DAYOFWEEK(rs.start_time), DAYNAME(rs.start_time)
-            ORDER BY DAYOFWEEK(rs.start_time)
-        """)
-        clear_gauge_metrics(booklore_reading_sessions_by_weekday)
-        for row in cursor.fetchall():
-            booklore_reading_sessions_by_weekday.labels(user=row['username'], weekday=row['weekday']).set(row['sessions'])
-
-        # =====================================================================
-        # BOOKS FINISHED OVER TIME
-        # =====================================================================
-
-        # Books finished by month (last 12 months)
-        cursor.execute("""
-            SELECT u.username, DATE_FORMAT(ubp.date_finished, '%Y-%m') as ym, COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.date_finished IS NOT NULL
-              AND ubp.date_finished >= DATE_SUB(CURDATE(), INTERVAL 12 MONTH)
-            GROUP BY u.id, u.username, DATE_FORMAT(ubp.date_finished, '%Y-%m')
-        """)
-        clear_gauge_metrics(booklore_books_finished_by_month)
-        for row in cursor.fetchall():
-            booklore_books_finished_by_month.labels(user=row['username'], ym=row['ym']).set(row['count'])
-
-        # Books finished this year
-        cursor.execute("""
-            SELECT u.username, COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.date_finished IS NOT NULL AND YEAR(ubp.date_finished) = YEAR(CURDATE())
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_books_finished_this_year)
-        for row in cursor.fetchall():
-            booklore_books_finished_this_year.labels(user=row['username']).set(row['count'])
-
-        # Books finished this month
-        cursor.execute("""
-            SELECT u.username, COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.date_finished IS NOT NULL
-              AND YEAR(ubp.date_finished) = YEAR(CURDATE())
-              AND MONTH(ubp.date_finished) = MONTH(CURDATE())
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_books_finished_this_month)
-        for row in cursor.fetchall():
-            booklore_books_finished_this_month.labels(user=row['username']).set(row['count'])
-
-        # =====================================================================
-        # RECENT ACTIVITY
-        # =====================================================================
-
-        # Last read timestamp
-        cursor.execute("""
-            SELECT u.username, MAX(rs.end_time) as last_read
-            FROM users u
-            LEFT JOIN reading_sessions rs ON u.id = rs.user_id
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_last_read_timestamp)
-        for row in cursor.fetchall():
-            if row['last_read']:
-                booklore_last_read_timestamp.labels(user=row['username']).set(row['last_read'].timestamp())
-
-        # Books read last 7 days
-        cursor.execute("""
-            SELECT u.username, COUNT(DISTINCT rs.book_id) as count
-            FROM users u
-            JOIN reading_sessions rs ON u.id = rs.user_id
-            WHERE rs.start_time >= DATE_SUB(NOW(), INTERVAL 7 DAY)
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_books_read_last_7_days)
-        for row in cursor.fetchall():
-            booklore_books_read_last_7_days.labels(user=row['username']).set(row['count'])
-
-        # Reading time last 7 days
-        cursor.execute("""
-            SELECT u.username, COALESCE(SUM(rs.duration_seconds), 0) as total_seconds
-            FROM users u
-            LEFT JOIN reading_sessions rs ON u.id = rs.user_id AND rs.start_time >= DATE_SUB(NOW(), INTERVAL 7 DAY)
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_reading_time_last_7_days_seconds)
-        for row in cursor.fetchall():
-            booklore_reading_time_last_7_days_seconds.labels(user=row['username']).set(row['total_seconds'])
-
-        # Reading time last 30 days
-        cursor.execute("""
-            SELECT u.username, COALESCE(SUM(rs.duration_seconds), 0) as total_seconds
-            FROM users u
-            LEFT JOIN reading_sessions rs ON u.id = rs.user_id AND rs.start_time >= DATE_SUB(NOW(), INTERVAL 30 DAY)
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_reading_time_last_30_days_seconds)
-        for row in cursor.fetchall():
-            booklore_reading_time_last_30_days_seconds.labels(user=row['username']).set(row['total_seconds'])
-
-        # =====================================================================
-        # KOREADER SYNC METRICS
-        # =====================================================================
-
-        # KOReader synced books
-        cursor.execute("""
-            SELECT u.username, ubp.koreader_device, COUNT(*) as count
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.koreader_device IS NOT NULL
-            GROUP BY u.id, u.username, ubp.koreader_device
-        """)
-        clear_gauge_metrics(booklore_koreader_synced_books)
-        for row in cursor.fetchall():
-            booklore_koreader_synced_books.labels(user=row['username'], device=row['koreader_device']).set(row['count'])
-
-        # Last KOReader sync
-        cursor.execute("""
-            SELECT u.username, MAX(ubp.koreader_last_sync_time) as last_sync
-            FROM users u
-            JOIN user_book_progress ubp ON u.id = ubp.user_id
-            WHERE ubp.koreader_last_sync_time IS NOT NULL
-            GROUP BY u.id, u.username
-        """)
-        clear_gauge_metrics(booklore_koreader_last_sync_timestamp)
-        for row in cursor.fetchall():
-            if row['last_sync']:
-                booklore_koreader_last_sync_timestamp.labels(user=row['username']).set(row['last_sync'].timestamp())
-
-        # =====================================================================
-        # SCRAPE METRICS
-        # =====================================================================
-
-        booklore_last_scrape.set(time.time())
-        duration = time.time() - start_time
-        booklore_scrape_duration.set(duration)
-
-        cursor.close()
-        conn.close()
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Metrics collected successfully in {duration:.2f}s")
-
-    except Exception as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Error collecting metrics: {e}")
+# =============================================================================
+# COLLECTION JOBS
+# =============================================================================
+# Each job runs its queries on one pooled connection and returns
+# [(gauge, [(labels, value), ...])]; collect_metrics publishes every job's
+# result in one snapshot at the end.
+
+def collect_library_totals(cursor):
+    """Books by library and read status, entity totals and series"""
+    updates = []
+
+    # Books by library and read status
+    cursor.execute("""
+        SELECT l.name as library, COALESCE(b.read_status, 'UNREAD') as read_status, COUNT(*) as count
+        FROM book b
+        JOIN library l ON b.library_id = l.id
+        WHERE b.deleted = 0
+        GROUP BY l.name, b.read_status
+    """)
+    updates.append((booklore_books_total, [
+        ({'library': row['library'], 'read_status': row['read_status']}, row['count'])
+        for row in cursor.fetchall()
+    ]))
+
+    # Total users, libraries, authors, shelves and categories
+    for gauge, table in ((booklore_users_total, 'users'),
+                         (booklore_libraries_total, 'library'),
+                         (booklore_authors_total, 'author'),
+                         (booklore_shelves_total, 'shelf'),
+                         (booklore_categories_total, 'category')):
+        cursor.execute(f"SELECT COUNT(*) as count FROM {table}")
+        updates.append((gauge, [({}, cursor.fetchone()['count'])]))
+
+    # Series metrics
+    cursor.execute("""
+        SELECT COUNT(*) as count FROM book_metadata WHERE series_name IS NOT NULL AND series_name != ''
+    """)
+    updates.append((booklore_books_with_series, [({}, cursor.fetchone()['count'])]))
+
+    cursor.execute("""
+        SELECT COUNT(DISTINCT series_name) as count FROM book_metadata WHERE series_name IS NOT NULL AND series_name != ''
+    """)
+    updates.append((booklore_series_total, [({}, cursor.fetchone()['count'])]))
+
+    return updates
+
+
+def collect_books_by_type(cursor):
+    """Books by file type"""
+    cursor.execute("""
+        SELECT UPPER(SUBSTRING_INDEX(file_name, '.', -1)) as file_type, COUNT(DISTINCT book_id) as count
+        FROM book_file
+        GROUP BY file_type
+    """)
+    return [(booklore_books_by_type, [({'file_type': row['file_type']}, row['count']) for row in cursor.fetchall()])]
+
+
+def collect_books_by_category(cursor):
+    """Books by category (top 20)"""
+    cursor.execute("""
+        SELECT c.name, COUNT(DISTINCT bcm.book_id) as book_count
+        FROM category c
+        JOIN book_metadata_category_mapping bcm ON c.id = bcm.category_id
+        GROUP BY c.id, c.name
+        ORDER BY book_count DESC
+        LIMIT 20
+    """)
+    return [(booklore_books_by_category, [({'category': row['name']}, row['book_count']) for row in cursor.fetchall()])]
+
+
+def collect_books_by_author(cursor):
+    """Books by author (top 20)"""
+    cursor.execute("""
+        SELECT a.name, COUNT(DISTINCT bam.book_id) as book_count
+        FROM author a
+        JOIN book_metadata_author_mapping bam ON a.id = bam.author_id
+        GROUP BY a.id, a.name
+        ORDER BY book_count DESC
+        LIMIT 20
+    """)
+    return [(booklore_books_by_author, [({'author': row['name']}, row['book_count']) for row in cursor.fetchall()])]
+
+
+def collect_user_progress(cursor):
+    """Read status, progress and finished books per user"""
+    updates = []
+
+    # Books by read status per user
+    cursor.execute("""
+        SELECT u.username, COALESCE(ubp.read_status, 'NONE') as status, COUNT(*) as count
+        FROM users u
+        LEFT JOIN user_book_progress ubp ON u.id = ubp.user_id
+        GROUP BY u.id, u.username, ubp.read_status
+    """)
+    updates.append((booklore_user_books_by_status, [
+        ({'user': row['username'], 'status': row['status']}, row['count'])
+        for row in cursor.fetchall() if row['status']
+    ]))
+
+    # Books with progress
+    cursor.execute("""
+        SELECT u.username, COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE COALESCE(ubp.pdf_progress_percent, ubp.epub_progress_percent, ubp.cbx_progress_percent, ubp.koreader_progress_percent, 0) > 0
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_user_books_with_progress, [({'user': row['username']}, row['count']) for row in cursor.fetchall()]))
+
+    # Books finished per user
+    cursor.execute("""
+        SELECT u.username, COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.read_status = 'READ'
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_user_books_finished, [({'user': row['username']}, row['count']) for row in cursor.fetchall()]))
+
+    # Average progress per user
+    cursor.execute("""
+        SELECT u.username,
+               AVG(GREATEST(
+                   COALESCE(ubp.pdf_progress_percent, 0),
+                   COALESCE(ubp.epub_progress_percent, 0),
+                   COALESCE(ubp.cbx_progress_percent, 0),
+                   COALESCE(ubp.koreader_progress_percent, 0)
+               )) as avg_progress
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_user_average_progress, [
+        ({'user': row['username']}, row['avg_progress'])
+        for row in cursor.fetchall() if row['avg_progress'] is not None
+    ]))
+
+    # Books by progress range
+    cursor.execute("""
+        SELECT u.username,
+               CASE
+                   WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) = 0 THEN '0%'
+                   WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) <= 0.25 THEN '1-25%'
+                   WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) <= 0.50 THEN '26-50%'
+                   WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) <= 0.75 THEN '51-75%'
+                   WHEN COALESCE(ubp.koreader_progress_percent, ubp.epub_progress_percent, ubp.pdf_progress_percent, ubp.cbx_progress_percent, 0) < 1.0 THEN '76-99%'
+                   ELSE '100%'
+               END as progress_range,
+               COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        GROUP BY u.id, u.username, progress_range
+    """)
+    updates.append((booklore_user_books_by_progress_range, [
+        ({'user': row['username'], 'progress_range': row['progress_range']}, row['count'])
+        for row in cursor.fetchall()
+    ]))
+
+    return updates
+
+
+def collect_user_ratings(cursor):
+    """Rated books, average rating and books by rating per user"""
+    updates = []
+
+    # Books rated
+    cursor.execute("""
+        SELECT u.username, COUNT(*) as count, AVG(ubp.personal_rating) as avg_rating
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.personal_rating IS NOT NULL
+        GROUP BY u.id, u.username
+    """)
+    rows = cursor.fetchall()
+    updates.append((booklore_user_books_rated, [({'user': row['username']}, row['count']) for row in rows]))
+    updates.append((booklore_user_average_rating, [
+        ({'user': row['username']}, row['avg_rating']) for row in rows if row['avg_rating']
+    ]))
+
+    # Books by personal rating
+    cursor.execute("""
+        SELECT u.username, ubp.personal_rating as rating, COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.personal_rating IS NOT NULL
+        GROUP BY u.id, u.username, ubp.personal_rating
+    """)
+    updates.append((booklore_user_books_by_rating, [
+        ({'user': row['username'], 'rating': str(row['rating'])}, row['count'])
+        for row in cursor.fetchall()
+    ]))
+
+    return updates
+
+
+def collect_session_rollups(cursor):
+    """All-history reading_sessions aggregates, folded in incrementally"""
+    global session_rollups, book_categories, book_categories_loaded_at
+    rollups = session_rollups
+    if rollups is None or time.time() - rollups.reconciled_at >= ROLLUP_RECONCILE_INTERVAL:
+        # Rebuilt off to the side; a failed rebuild leaves the current rollups in place
+        rollups = SessionRollups()
+    rollups.fold(cursor)
+    session_rollups = rollups
+
+    # The catalogue side changes rarely, so only the sessions are folded every cycle
+    if book_categories is None or time.time() - book_categories_loaded_at >= COST_INTERVALS['expensive']:
+        book_categories = load_book_categories(cursor)
+        book_categories_loaded_at = time.time()
+
+    cursor.execute("SELECT id, username FROM users")
+    users = cursor.fetchall()
+
+    total_seconds, average_duration = [], []
+    type_sessions, type_seconds, by_hour, by_weekday = [], [], [], []
+    category_seconds = defaultdict(int)
+    for user in users:
+        username = user['username']
+        rollup = rollups.users.get(user['id'])
+        if rollup is None:
+            total_seconds.append(({'user': username}, 0))
+            continue
+        total_seconds.append(({'user': username}, rollup.seconds))
+        if rollup.timed_sessions:
+            # MariaDB's AVG of an integer column: 4 decimals, rounded half up
+            average = (Decimal(rollup.seconds) / rollup.timed_sessions).quantize(Decimal('0.0001'), ROUND_HALF_UP)
+            if average:
+                average_duration.append(({'user': username}, average))
+        for book_type, (sessions, seconds) in rollup.by_book_type.items():
+            type_sessions.append(({'user': username, 'book_type': book_type}, sessions))
+            type_seconds.append(({'user': username, 'book_type': book_type}, seconds))
+        for hour, sessions in rollup.by_hour.items():
+            by_hour.append(({'user': username, 'hour': str(hour).zfill(2)}, sessions))
+        for weekday, sessions in rollup.by_weekday.items():
+            by_weekday.append(({'user': username, 'weekday': weekday}, sessions))
+        for book_id, seconds in rollup.seconds_by_book.items():
+            for category in book_categories.get(book_id, ()):
+                category_seconds[(username, category)] += seconds
+
+    # Reading time by category/genre (top 15)
+    top_categories = sorted(category_seconds.items(), key=lambda item: item[1], reverse=True)[:15]
+
+    return [
+        (booklore_reading_sessions_total, [({}, sum(rollup.sessions for rollup in rollups.users.values()))]),
+        (booklore_reading_time_total_seconds, total_seconds),
+        (booklore_average_session_duration_seconds, average_duration),
+        (booklore_reading_sessions_by_book_type, type_sessions),
+        (booklore_reading_time_by_book_type, type_seconds),
+        (booklore_reading_sessions_by_hour, by_hour),
+        (booklore_reading_sessions_by_weekday, by_weekday),
+        (booklore_reading_time_by_category, [
+            ({'user': username, 'category': category}, seconds) for (username, category), seconds in top_categories
+        ]),
+    ]
+
+
+def collect_sessions_by_date(cursor):
+    """Reading sessions by date (last 30 days)"""
+    cursor.execute("""
+        SELECT u.username, DATE(rs.start_time) as date,
+               COUNT(*) as sessions,
+               SUM(rs.duration_seconds) as total_seconds,
+               SUM(rs.progress_delta) as total_progress
+        FROM users u
+        JOIN reading_sessions rs ON u.id = rs.user_id
+        WHERE rs.start_time >= DATE_SUB(CURDATE(), INTERVAL 30 DAY)
+        GROUP BY u.id, u.username, DATE(rs.start_time)
+    """)
+    sessions, seconds, progress = [], [], []
+    for row in cursor.fetchall():
+        labels = {'user': row['username'], 'date': row['date'].strftime('%Y-%m-%d')}
+        sessions.append((labels, row['sessions']))
+        seconds.append((labels, row['total_seconds']))
+        progress.append((labels, row['total_progress'] or 0))
+    return [
+        (booklore_reading_sessions_by_date, sessions),
+        (booklore_reading_time_by_date, seconds),
+        (booklore_reading_progress_by_date, progress),
+    ]
+
+
+def collect_streaks(cursor):
+    """Reading streaks and days read this month/year"""
+    # Distinct reading days of every user in one pass (NULL for users without sessions)
+    cursor.execute("""
+        SELECT u.id, u.username, DATE(rs.start_time) as read_date
+        FROM users u
+        LEFT JOIN reading_sessions rs ON u.id = rs.user_id
+        GROUP BY u.id, u.username, DATE(rs.start_time)
+    """)
+    read_dates_by_user = {}
+    for row in cursor.fetchall():
+        read_dates = read_dates_by_user.setdefault(row['username'], [])
+        if row['read_date'] is not None:
+            read_dates.append(row['read_date'])
+
+    # Days read this month/year per user
+    cursor.execute("""
+        SELECT u.username,
+               COUNT(DISTINCT CASE WHEN YEAR(rs.start_time) = YEAR(CURDATE()) AND MONTH(rs.start_time) = MONTH(CURDATE())
+                                   THEN DATE(rs.start_time) END) as days_this_month,
+               COUNT(DISTINCT CASE WHEN YEAR(rs.start_time) = YEAR(CURDATE())
+                                   THEN DATE(rs.start_time) END) as days_this_year
+        FROM users u
+        LEFT JOIN reading_sessions rs ON u.id = rs.user_id
+        GROUP BY u.id, u.username
+    """)
+    habits = cursor.fetchall()
+
+    today = datetime.now().date()
+    current, longest = [], []
+    for username, read_dates in read_dates_by_user.items():
+        read_dates.sort(reverse=True)
+        current.append(({'user': username}, current_streak(read_dates, today)))
+        longest.append(({'user': username}, longest_streak(read_dates)))
+
+    return [
+        (booklore_current_reading_streak_days, current),
+        (booklore_longest_reading_streak_days, longest),
+        (booklore_days_read_this_month, [({'user': row['username']}, row['days_this_month']) for row in habits]),
+        (booklore_days_read_this_year, [({'user': row['username']}, row['days_this_year']) for row in habits]),
+    ]
+
+
+def collect_books_finished(cursor):
+    """Books finished by month, this year and this month"""
+    updates = []
+
+    # Books finished by month (last 12 months)
+    cursor.execute("""
+        SELECT u.username, DATE_FORMAT(ubp.date_finished, '%Y-%m') as ym, COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.date_finished IS NOT NULL
+          AND ubp.date_finished >= DATE_SUB(CURDATE(), INTERVAL 12 MONTH)
+        GROUP BY u.id, u.username, DATE_FORMAT(ubp.date_finished, '%Y-%m')
+    """)
+    updates.append((booklore_books_finished_by_month, [
+        ({'user': row['username'], 'ym': row['ym']}, row['count']) for row in cursor.fetchall()
+    ]))
+
+    # Books finished this year
+    cursor.execute("""
+        SELECT u.username, COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.date_finished IS NOT NULL AND YEAR(ubp.date_finished) = YEAR(CURDATE())
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_books_finished_this_year, [({'user': row['username']}, row['count']) for row in cursor.fetchall()]))
+
+    # Books finished this month
+    cursor.execute("""
+        SELECT u.username, COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.date_finished IS NOT NULL
+          AND YEAR(ubp.date_finished) = YEAR(CURDATE())
+          AND MONTH(ubp.date_finished) = MONTH(CURDATE())
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_books_finished_this_month, [({'user': row['username']}, row['count']) for row in cursor.fetchall()]))
+
+    return updates
+
+
+def collect_recent_activity(cursor):
+    """Last read time and reading over the last 7/30 days"""
+    updates = []
+
+    # Last read timestamp
+    cursor.execute("""
+        SELECT u.username, MAX(rs.end_time) as last_read
+        FROM users u
+        LEFT JOIN reading_sessions rs ON u.id = rs.user_id
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_last_read_timestamp, [
+        ({'user': row['username']}, row['last_read'].timestamp()) for row in cursor.fetchall() if row['last_read']
+    ]))
+
+    # Books read last 7 days
+    cursor.execute("""
+        SELECT u.username, COUNT(DISTINCT rs.book_id) as count
+        FROM users u
+        JOIN reading_sessions rs ON u.id = rs.user_id
+        WHERE rs.start_time >= DATE_SUB(NOW(), INTERVAL 7 DAY)
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_books_read_last_7_days, [({'user': row['username']}, row['count']) for row in cursor.fetchall()]))
+
+    # Reading time last 7 days
+    cursor.execute("""
+        SELECT u.username, COALESCE(SUM(rs.duration_seconds), 0) as total_seconds
+        FROM users u
+        LEFT JOIN reading_sessions rs ON u.id = rs.user_id AND rs.start_time >= DATE_SUB(NOW(), INTERVAL 7 DAY)
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_reading_time_last_7_days_seconds, [
+        ({'user': row['username']}, row['total_seconds']) for row in cursor.fetchall()
+    ]))
+
+    # Reading time last 30 days
+    cursor.execute("""
+        SELECT u.username, COALESCE(SUM(rs.duration_seconds), 0) as total_seconds
+        FROM users u
+        LEFT JOIN reading_sessions rs ON u.id = rs.user_id AND rs.start_time >= DATE_SUB(NOW(), INTERVAL 30 DAY)
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_reading_time_last_30_days_seconds, [
+        ({'user': row['username']}, row['total_seconds']) for row in cursor.fetchall()
+    ]))
+
+    return updates
+
+
+def collect_koreader(cursor):
+    """KOReader synced books per device and last sync time"""
+    updates = []
+
+    # KOReader synced books
+    cursor.execute("""
+        SELECT u.username, ubp.koreader_device, COUNT(*) as count
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.koreader_device IS NOT NULL
+        GROUP BY u.id, u.username, ubp.koreader_device
+    """)
+    updates.append((booklore_koreader_synced_books, [
+        ({'user': row['username'], 'device': row['koreader_device']}, row['count']) for row in cursor.fetchall()
+    ]))
+
+    # Last KOReader sync
+    cursor.execute("""
+        SELECT u.username, MAX(ubp.koreader_last_sync_time) as last_sync
+        FROM users u
+        JOIN user_book_progress ubp ON u.id = ubp.user_id
+        WHERE ubp.koreader_last_sync_time IS NOT NULL
+        GROUP BY u.id, u.username
+    """)
+    updates.append((booklore_koreader_last_sync_timestamp, [
+        ({'user': row['username']}, row['last_sync'].timestamp()) for row in cursor.fetchall() if row['last_sync']
+    ]))
+
+    return updates
+
+
+class CollectionJob:
+    """A collect_* function with its cost class and the time it is next due"""
+
+    def __init__(self, collect, cost):
+        self.collect = collect
+        self.name = collect.__name__[len('collect_'):]
+        self.cost = cost
+        self.interval = REFRESH_INTERVALS.get(self.name, COST_INTERVALS[cost])
+        # 0 = never ran; every job runs in the first cycle so the snapshot starts complete
+        self.next_due = 0
+        self.last_success = None
+
+
+# Heaviest first so they start before the pool fills up with cheap jobs
+COLLECTION_JOBS = [
+    CollectionJob(collect_streaks, 'moderate'),
+    # Incremental, so cheap once the first cycle has built the rollups
+    CollectionJob(collect_session_rollups, 'cheap'),
+    CollectionJob(collect_recent_activity, 'cheap'),
+    CollectionJob(collect_sessions_by_date, 'moderate'),
+    CollectionJob(collect_books_by_author, 'expensive'),
+    CollectionJob(collect_books_by_category, 'expensive'),
+    CollectionJob(collect_books_by_type, 'moderate'),
+    CollectionJob(collect_library_totals, 'cheap'),
+    CollectionJob(collect_user_progress, 'cheap'),
+    CollectionJob(collect_user_ratings, 'cheap'),
+    CollectionJob(collect_books_finished, 'cheap'),
+    CollectionJob(collect_koreader, 'cheap'),
+]
+
+
+def due_jobs(now):
+    """Jobs to run this cycle, in COLLECTION_JOBS order"""
+    due = [job for job in COLLECTION_JOBS if job.next_due <= now]
+    # Most overdue expensive jobs first; the rest wait for a later cycle
+    expensive = sorted((job for job in due if job.cost == 'expensive' and job.next_due), key=lambda job: job.next_due)
+    deferred = set(expensive[EXPENSIVE_JOBS_PER_CYCLE:])
+    return [job for job in due if job not in deferred]
+
+
+def run_job(job):
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            return job.collect(cursor)
+        finally:
+            cursor.close()
+
+
+def collect_metrics():
+    start_time = time.time()
+    jobs = due_jobs(start_time)
+    futures = [(job, executor.submit(run_job, job)) for job in jobs]
+
+    families = []
+    failed = False
+    for job, future in futures:
+        try:
+            # Built here so a bad sample fails only its own job
+            families += [(gauge, gauge.family(samples)) for gauge, samples in future.result()]
+        except Exception as e:
+            # Retried next cycle
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Error collecting metrics ({job.name}): {e}")
+            failed = True
+        else:
+            job.next_due = start_time + job.interval
+            job.last_success = time.time()
+    families.append((booklore_job_last_success, booklore_job_last_success.family([
+        ({'job': job.name}, job.last_success) for job in COLLECTION_JOBS if job.last_success
+    ])))
+    # Gauges of failed or skipped jobs keep their previous samples
+    snapshot.publish(families)
+
+    # =========================================================================
+    # SCRAPE METRICS
+    # =========================================================================
+
+    if failed:
         booklore_scrape_errors.inc()
+        return
+
+    booklore_last_scrape.set(time.time())
+    duration = time.time() - start_time
+    booklore_scrape_duration.set(duration)
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Metrics collected successfully in {duration:.2f}s "
+          f"({len(jobs)}/{len(COLLECTION_JOBS)} jobs due)")
 
 
 def main():
     print(f"Starting BookLore Prometheus Exporter on port {EXPORTER_PORT}")
     print(f"Scrape interval: {SCRAPE_INTERVAL} seconds")
-    print(f"Database: {DB_HOST}:{DB_PORT}/{DB_NAME}")
+    print(f"Database: {DB_HOST}:{DB_PORT}/{DB_NAME} ({DB_POOL_SIZE} connections)")
+    for job in COLLECTION_JOBS:
+        print(f"  {job.name}: {job.cost}, every {job.interval}s")
 
     # Start HTTP server
     start_http_server(EXPORTER_PORT)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Sync Bridge Benchmark
+
+Builds a synthetic AnthoLume database and BookLore catalogue, then times
+catalogue loading, matching and both sync phases of sync.py end to end.
+BookLore is an SQLite stand-in that speaks the MariaDB dialect sync.py uses,
+so no live database is needed.
+
+    python bench.py --books 1000,10000,100000 --profile
+"""
+
+import os
+import re
+import sys
+import time
+import zlib
+import random
+import shutil
+import sqlite3
+import hashlib
+import logging
+import argparse
+import cProfile
+import pstats
+import tempfile
+from datetime import datetime, timedelta
+
+import sync
+
+SEED = 42
+
+BOOKLORE_SCHEMA = """
+CREATE TABLE book (id INTEGER PRIMARY KEY, deleted INTEGER DEFAULT 0);
+CREATE TABLE book_metadata (book_id INTEGER PRIMARY KEY, title TEXT);
+CREATE TABLE author (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE book_metadata_author_mapping (book_id INTEGER, author_id INTEGER);
+CREATE INDEX bam_book ON book_metadata_author_mapping (book_id);
+CREATE TABLE book_file (id INTEGER PRIMARY KEY, book_id INTEGER, file_name TEXT,
+                        initial_hash TEXT, current_hash TEXT);
+CREATE INDEX bf_book ON book_file (book_id);
+CREATE TABLE reading_sessions (id INTEGER PRIMARY KEY, user_id INTEGER, book_id INTEGER, book_type TEXT,
+                               start_time DATETIME, end_time DATETIME, duration_seconds INTEGER,
+                               start_progress REAL, end_progress REAL, progress_delta REAL,
+                               start_location TEXT, end_location TEXT, created_at DATETIME);
+CREATE INDEX rs_book ON reading_sessions (user_id, book_id, start_time);
+CREATE TABLE user_book_progress (id INTEGER PRIMARY KEY, user_id INTEGER, book_id INTEGER,
+                                 koreader_progress TEXT, koreader_progress_percent REAL,
+                                 koreader_device TEXT, koreader_device_id TEXT,
+                                 koreader_last_sync_time DATETIME, last_read_time DATETIME,
+                                 read_status TEXT, UNIQUE (user_id, book_id));
+"""
+
+ANTHOLUME_SCHEMA = """
+CREATE TABLE documents (id TEXT PRIMARY KEY, md5 TEXT, filepath TEXT, title TEXT, author TEXT);
+CREATE TABLE activity (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, document_id TEXT, device_id TEXT,
+                       start_time DATETIME, duration INTEGER, start_percentage REAL, end_percentage REAL);
+CREATE TABLE document_progress (user_id TEXT, document_id TEXT, device_id TEXT, percentage REAL, progress TEXT,
+                                PRIMARY KEY (user_id, document_id, device_id));
+"""
+
+
+# =============================================================================
+# BOOKLORE STAND-IN
+# =============================================================================
+
+class GroupConcat:
+    """GROUP_CONCAT(DISTINCT x SEPARATOR sep) as an SQLite aggregate"""
+
+    def __init__(self):
+        self.items = []
+        self.sep = ','
+
+    def step(self, value, sep):
+        self.sep = sep
+        if value is not None and value not in self.items:
+            self.items.append(value)
+
+    def finalize(self):
+        return self.sep.join(str(item) for item in self.items) if self.items else None
+
+
+def to_sqlite(query, has_args):
+    """Rewrite the MariaDB/pymysql SQL used by sync.py for SQLite"""
+    query = re.sub(r"GROUP_CONCAT\(DISTINCT (.+?) SEPARATOR '(.*?)'\)", r"group_concat_distinct(\1, '\2')", query)
+    query = query.replace('SELECT NOW() as now', 'SELECT datetime(\'now\') as "now [DATETIME]"')
+    query = query.replace('ON DUPLICATE KEY UPDATE', 'ON CONFLICT (user_id, book_id) DO UPDATE SET')
+    query = re.sub(r'VALUES\((\w+)\)', r'excluded.\1', query)
+    query = query.replace('%s', '?')
+    if has_args:
+        query = query.replace('%%', '%')
+    return query
+
+
+def parse_datetime(value):
+    return datetime.fromisoformat(value.decode())
+
+
+sqlite3.register_converter('DATETIME', parse_datetime)
+sqlite3.register_adapter(datetime, lambda dt: dt.replace(tzinfo=None).isoformat(' '))
+
+
+class StandInCursor:
+    """Just enough of a pymysql DictCursor for sync.py"""
+
+    def __init__(self, db):
+        self.cursor = db.cursor()
+
+    def execute(self, query, args=None):
+        self.cursor.execute(to_sqlite(query, args is not None), tuple(args or ()))
+        return self.cursor.rowcount
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(to_sqlite(query, True), [tuple(row) for row in rows])
+
+    def _row(self, row):
+        if row is None:
+            return None
+        return {column[0].split(' ')[0]: value for column, value in zip(self.cursor.description, row)}
+
+    def fetchone(self):
+        return self._row(self.cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+    def close(self):
+        self.cursor.close()
+
+
+class StandInConnection:
+    """SQLite database behind a pymysql-like connection"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        self.db.create_aggregate('group_concat_distinct', 2, GroupConcat)
+        self.db.create_function('CRC32', 1, lambda s: zlib.crc32(str(s).encode()) if s is not None else None)
+        self.db.create_function('CONCAT_WS', -1, lambda sep, *a: sep.join(str(x) for x in a if x is not None))
+
+    def cursor(self):
+        return StandInCursor(self.db)
+
+    def ping(self, reconnect=True):
+        return True
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+# =============================================================================
+# SYNTHETIC DATA
+# =============================================================================
+
+def make_words(rng, count):
+    syllables = ['ka', 'lo', 'mi', 'ra', 'ten', 'dor', 'vel', 'an', 'is', 'or', 'th', 'el', 'un', 'sa', 'qu', 'bre']
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def make_library(rng, n_books):
+    """(id, title, author, filename, md5) for n_books synthetic books"""
+    words = make_words(rng, 5000)
+    authors = [f'{rng.choice(words).title()} {rng.choice(words).title()}' for _ in range(max(n_books // 5, 10))]
+    books = []
+    for book_id in range(1, n_books + 1):
+        title = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 5))).title()
+        author = rng.choice(authors)
+        ext = rng.choice(['.epub', '.epub', '.epub', '.pdf', '.cbz'])
+        filename = f"{author} - {title}{ext}"
+        md5 = hashlib.md5(f'{book_id}:{title}'.encode()).hexdigest()
+        books.append((book_id, title, author, filename, md5))
+    return books, words
+
+
+def build_booklore(path, books):
+    conn = StandInConnection(path)
+    db = conn.db
+    db.executescript(BOOKLORE_SCHEMA)
+    author_ids = {}
+    for book_id, title, author, filename, md5 in books:
+        author_id = author_ids.setdefault(author, len(author_ids) + 1)
+        db.execute("INSERT INTO book (id) VALUES (?)", (book_id,))
+        db.execute("INSERT INTO book_metadata (book_id, title) VALUES (?, ?)", (book_id, title))
+        db.execute("INSERT INTO book_metadata_author_mapping VALUES (?, ?)", (book_id, author_id))
+        db.execute("INSERT INTO book_file (book_id, file_name, initial_hash) VALUES (?, ?, ?)",
+                   (book_id, filename, md5))
+    db.executemany("INSERT INTO author (id, name) VALUES (?, ?)", [(i, a) for a, i in author_ids.items()])
+    db.commit()
+    return conn
+
+
+def make_documents(rng, books, words, n_documents):
+    """AnthoLume documents for a sample of books: md5, KOReader id, fuzzy and unmatched in equal parts"""
+    documents = []
+    for i, (book_id, title, author, filename, md5) in enumerate(rng.sample(books, min(n_documents, len(books)))):
+        kind = i % 4
+        if kind == 0:
+            documents.append((hashlib.md5(f'doc{i}'.encode()).hexdigest(), md5, f'/books/{filename}', title, author))
+        elif kind == 1:
+            documents.append((md5[:16] + hashlib.md5(f'doc{i}'.encode()).hexdigest()[:16], None,
+                              f'/books/{filename}', title, author))
+        elif kind == 2:
+            documents.append((hashlib.md5(f'doc{i}'.encode()).hexdigest(), None,
+                              f'/books/{filename.lower()}', title + '!', author))
+        else:
+            documents.append((hashlib.md5(f'doc{i}'.encode()).hexdigest(), None, '/books/unknown.epub',
+                              ' '.join(rng.choice(words) for _ in range(3)), 'Nobody'))
+    return documents
+
+
+def build_antholume(path, rng, documents, n_activities):
+    db = sqlite3.connect(path)
+    db.executescript(ANTHOLUME_SCHEMA)
+    db.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?)", documents)
+    start = datetime(2020, 1, 1)
+    activities = []
+    for i in range(n_activities):
+        document_id = rng.choice(documents)[0]
+        start_time = start + timedelta(minutes=45 * i + rng.randint(0, 30))
+        start_pct = rng.random() * 0.9
+        activities.append(('bench', document_id, 'koreader', start_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                           rng.randint(60, 3600), start_pct, start_pct + 0.05))
+    db.executemany("""
+        INSERT INTO activity (user_id, document_id, device_id, start_time, duration, start_percentage, end_percentage)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, activities)
+    db.executemany("INSERT INTO document_progress VALUES ('bench', ?, 'koreader', ?, ?)",
+                   [(doc[0], rng.random(), f'/body/DocFragment[{i}]') for i, doc in enumerate(documents)])
+    db.commit()
+    db.close()
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def reset_sync_state(workdir):
+    """Point sync.py at workdir and drop everything it cached in memory"""
+    sync.ANTHOLUME_DB = os.path.join(workdir, 'antholume.db')
+    sync.SYNC_STATE_FILE = os.path.join(workdir, 'sync_state.txt')
+    sync.MATCH_CACHE_FILE = os.path.join(workdir, 'match_cache.db')
+    sync.PROGRESS_STATE_FILE = os.path.join(workdir, 'progress_state.db')
+    sync.book_cache = {}
+    sync.book_index = None
+    sync.book_digests = {}
+    sync.catalogue_loaded_at = 0
+    sync.sources = None
+    sync.vector_scorer = None
+    sync.close_match_pool()
+    sync.no_match_logged.clear()
+
+
+def timed(label, count, unit, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    rate = f"{count / elapsed:,.0f} {unit}/s" if elapsed > 0 else '-'
+    print(f"  {label:<28} {elapsed:8.3f}s  {rate}")
+    return result
+
+
+def run_benchmark(n_books, n_documents, n_activities, profile_top, profile_out, keep):
+    rng = random.Random(SEED)
+    workdir = tempfile.mkdtemp(prefix=f'sync-bench-{n_books}-')
+    print(f"\n{n_books:,} books, {n_documents:,} documents, {n_activities:,} activities ({workdir})")
+
+    books, words = make_library(rng, n_books)
+    booklore = build_booklore(os.path.join(workdir, 'booklore.db'), books)
+    documents = make_documents(rng, books, words, n_documents)
+    build_antholume(os.path.join(workdir, 'antholume.db'), rng, documents, n_activities)
+    sync.get_booklore_connection = lambda: booklore
+
+    # Catalogue load and raw matching, without the match cache
+    reset_sync_state(workdir)
+    timed('load_booklore_books', n_books, 'books', sync.load_booklore_books, booklore.cursor())
+    docs = [{'id': d[0], 'md5': d[1], 'filepath': d[2], 'title': d[3], 'author': d[4]} for d in documents]
+    timed('find_booklore_book', len(docs), 'docs', lambda: [sync.find_booklore_book(doc) for doc in docs])
+
+    # Cold end-to-end cycle: full backfill from an empty watermark
+    reset_sync_state(workdir)
+    session = sync.get_source().session
+    resolved = {}
+    stats = sync.get_source().stats = sync.CycleStats()
+    profiler = cProfile.Profile() if profile_top or profile_out else None
+    if profiler:
+        profiler.enable()
+    timed('sync_activities (cold)', n_activities, 'activities', sync.sync_activities, session, resolved)
+    timed('sync_progress (cold)', len(documents), 'rows', sync.sync_progress, session, resolved)
+    if profiler:
+        profiler.disable()
+    print(f"  {stats.summary()}")
+
+    # Warm cycle: nothing new, catalogue and match cache already loaded
+    timed('run_cycle (idle)', 1, 'cycles', sync.run_cycle, session)
+
+    if profiler:
+        if profile_out:
+            path = f'{profile_out}.{n_books}'
+            profiler.dump_stats(path)
+            print(f"  Profile written to {path}")
+        if profile_top:
+            print(f"  Top {profile_top} functions by cumulative time (cold cycle):")
+            stats = pstats.Stats(profiler, stream=sys.stdout)
+            stats.strip_dirs().sort_stats('cumulative').print_stats(profile_top)
+
+    session.close()
+    sync.close_match_pool()
+    booklore.close()
+    if not keep:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AnthoLume to BookLore sync bridge')
+    parser.add_argument('--books', default='1000,10000', help='comma-separated catalogue sizes')
+    parser.add_argument('--documents', type=int, default=1000, help='AnthoLume documents')
+    parser.add_argument('--activities', type=int, default=20000, help='AnthoLume activity rows')
+    parser.add_argument('--profile', nargs='?', const=25, type=int, default=0, metavar='N',
+                        help='print the N hottest functions of the cold cycle (default 25)')
+    parser.add_argument('--profile-out', help='write cProfile stats to this path (suffixed with the size)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated databases')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+    engine = 'numpy' if sync.np is not None and sync.SCORING_ENGINE != 'python' else 'python'
+    print(f"Scoring engine: {engine}, workers: {sync.SYNC_WORKERS}")
+    for n_books in (int(n) for n in args.books.split(',')):
+        run_benchmark(n_books, args.documents, args.activities, args.profile, args.profile_out, args.keep)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,36 @@ Matches books by title/author/filename and syncs reading sessions.
 
 import os
 import re
+import sys
+import logging
+import bisect
+import hashlib
+import json
 import time
 import sqlite3
+import tempfile
+import threading
+import multiprocessing
 import pymysql
+from urllib.parse import quote
+import collections
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 from difflib import SequenceMatcher
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:  # fuzzy scoring falls back to the pure-Python loop
+    np = None
+
+try:
+    from prometheus_client import start_http_server, Counter, Gauge, Histogram
+except ImportError:  # runs without the metrics endpoint
+    start_http_server = None
 
 # Configuration
 ANTHOLUME_DB = os.getenv('ANTHOLUME_DB', '/antholume/antholume.db')
@@ -24,15 +49,220 @@ BOOKLORE_PASSWORD = os.getenv('BOOKLORE_DB_PASSWORD', '')
 SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', 300))  # 5 minutes default
 BOOKLORE_USER_ID = int(os.getenv('BOOKLORE_USER_ID', 1))  # BookLore user ID
 
+# Per-book match and session lines are DEBUG; INFO gets a summary per cycle
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# An unmatched document is reported again only after this many seconds
+NO_MATCH_LOG_INTERVAL = int(os.getenv('NO_MATCH_LOG_INTERVAL', 86400))
+
+# Prometheus endpoint (needs prometheus_client); 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9093))
+
+# AnthoLume is read in keyset-paginated chunks on a read-only connection, so no
+# read snapshot is held between chunks (AnthoLume's WAL checkpoints aren't blocked)
+READ_CHUNK_SIZE = int(os.getenv('READ_CHUNK_SIZE', 1000))
+ANTHOLUME_CACHE_KB = int(os.getenv('ANTHOLUME_CACHE_KB', 8192))
+ANTHOLUME_MMAP_SIZE = int(os.getenv('ANTHOLUME_MMAP_SIZE', 64 * 1024 * 1024))
+# Only for a copy of the database that nothing writes to anymore
+ANTHOLUME_IMMUTABLE = os.getenv('ANTHOLUME_IMMUTABLE', '') == '1'
+
+# 'interval' syncs every SYNC_INTERVAL; 'watch' syncs when antholume.db changes,
+# with SYNC_INTERVAL as the longest gap between cycles; 'plan' writes what a
+# sync would change to PLAN_FILE once and exits without writing to BookLore
+SYNC_MODE = os.getenv('SYNC_MODE', 'interval')
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', 2))
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE', 10))  # wait for writes to settle
+
 # Track synced activities to avoid duplicates
 SYNC_STATE_FILE = '/config/sync_state.txt'
 
+# Remember document -> book matches across cycles; misses are retried with backoff
+MATCH_CACHE_FILE = os.path.join(os.path.dirname(SYNC_STATE_FILE), 'match_cache.db')
+MATCH_RETRY_BASE = int(os.getenv('MATCH_RETRY_BASE', 3600))  # 1 hour after the first miss
+MATCH_RETRY_MAX = int(os.getenv('MATCH_RETRY_MAX', 7 * 86400))  # then doubling up to a week
+
+# Last synced state of each AnthoLume document_progress row
+PROGRESS_STATE_FILE = os.path.join(os.path.dirname(SYNC_STATE_FILE), 'progress_state.db')
+
+# Several AnthoLume databases in one process, as "path:user_id,path:user_id".
+# They share one catalogue and sync concurrently; each keeps its watermark and
+# match/progress state under a directory of its own next to SYNC_STATE_FILE.
+# Empty means the single ANTHOLUME_DB -> BOOKLORE_USER_ID source.
+SYNC_SOURCES = os.getenv('SYNC_SOURCES', '')
+
+# Plan mode output (JSONL) and the activity id to replay from (default: the saved watermark)
+PLAN_FILE = os.getenv('PLAN_FILE', os.path.join(os.path.dirname(SYNC_STATE_FILE), 'sync_plan.jsonl'))
+PLAN_FROM_ID = os.getenv('PLAN_FROM_ID')
+
+# Fuzzy matching: each component counts once its similarity is above the
+# threshold and then adds similarity * weight; a book matches at MATCH_MIN_SCORE.
+# BookIndex candidate selection assumes thresholds at least as strict as these defaults.
+TITLE_THRESHOLD = float(os.getenv('MATCH_TITLE_THRESHOLD', 0.8))
+TITLE_WEIGHT = float(os.getenv('MATCH_TITLE_WEIGHT', 50))
+AUTHOR_THRESHOLD = float(os.getenv('MATCH_AUTHOR_THRESHOLD', 0.5))
+AUTHOR_WEIGHT = float(os.getenv('MATCH_AUTHOR_WEIGHT', 30))
+FILENAME_THRESHOLD = float(os.getenv('MATCH_FILENAME_THRESHOLD', 0.6))
+FILENAME_WEIGHT = float(os.getenv('MATCH_FILENAME_WEIGHT', 40))
+DOC_ID_FILENAME_BONUS = float(os.getenv('MATCH_DOC_ID_FILENAME_BONUS', 20))
+HASH_PREFIX_BONUS = float(os.getenv('MATCH_HASH_PREFIX_BONUS', 30))
+MATCH_MIN_SCORE = float(os.getenv('MATCH_MIN_SCORE', 40))
+# 'auto' uses the NumPy scorer when numpy is installed, 'python' never does
+SCORING_ENGINE = os.getenv('SCORING_ENGINE', 'auto')
+
+# Worker processes for fuzzy matching (1 = match in-process); workers are forked
+# once per catalogue change, shared by all sources, and only used for batches of
+# PARALLEL_MATCH_MIN+
+SYNC_WORKERS = int(os.getenv('SYNC_WORKERS', 1))
+PARALLEL_MATCH_MIN = int(os.getenv('PARALLEL_MATCH_MIN', 50))
+
+# Between full reloads only books whose digest changed are fetched from BookLore
+CATALOGUE_RELOAD_INTERVAL = int(os.getenv('CATALOGUE_RELOAD_INTERVAL', 86400))
+
+# Rows per executemany / books per duplicate prefetch query
+INSERT_BATCH_SIZE = 500
+PREFETCH_BATCH_SIZE = 200
+
+# Sessions starting within this many seconds of an existing one are duplicates
+DUPLICATE_WINDOW = timedelta(seconds=60)
+
+# Synced sessions carry start_location 'antholume:<document_id>:<activity_id>'
+# so a re-read activity is recognised exactly; older rows only have the document id
+SESSION_KEY_PREFIX = 'antholume:'
+
 # Cache for book matching
 book_cache = {}
+book_index = None
+book_digests = {}
+catalogue_loaded_at = 0
+vector_scorer = None
+match_pool = None
+match_pool_index = None  # (book_index, version) the match_pool workers were forked with
+match_pool_lock = threading.RLock()
+sources = None
+active = threading.local()  # .source: the SyncSource the current thread is syncing
+
+log = logging.getLogger('sync-bridge')
+no_match_logged = {}
+
+if start_http_server is not None:
+    PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+    sync_cycle_duration = Histogram('antholume_sync_cycle_duration_seconds', 'Duration of a sync cycle',
+                                    ['source'], buckets=PHASE_BUCKETS)
+    sync_phase_duration = Histogram('antholume_sync_phase_duration_seconds', 'Time spent per phase in a sync cycle',
+                                    ['source', 'phase'], buckets=PHASE_BUCKETS)
+    sync_matches = Counter('antholume_sync_matches_total', 'Documents resolved, by match method', ['source', 'method'])
+    sync_rows = Counter('antholume_sync_rows_total', 'Rows written to BookLore', ['source', 'table'])
+    sync_duplicates = Counter('antholume_sync_duplicate_sessions_total', 'Activities skipped as duplicate sessions',
+                              ['source'])
+    sync_errors = Counter('antholume_sync_errors_total', 'Failed sync phases', ['source'])
+    sync_last_sync_id = Gauge('antholume_sync_last_sync_id', 'Last AnthoLume activity id synced to BookLore',
+                              ['source'])
+    sync_source_max_id = Gauge('antholume_sync_source_max_activity_id', 'Highest activity id in AnthoLume', ['source'])
+    sync_newest_session_age = Gauge('antholume_sync_newest_session_age_seconds',
+                                    'Age of the newest reading session synced from AnthoLume', ['source'])
+
+
+class CycleStats:
+    """Counts and per-phase timings of one sync cycle, logged as a single summary line"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.counts = defaultdict(int)
+        self.timings = defaultdict(float)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - start
+
+    def summary(self):
+        counts = ', '.join(f'{name}={n}' for name, n in self.counts.items() if n) or 'nothing to sync'
+        timings = ', '.join(f'{phase}={secs:.2f}s' for phase, secs in self.timings.items())
+        return f"Cycle finished in {time.perf_counter() - self.started:.2f}s: {counts} ({timings})"
+
+
+def get_cycle_stats():
+    return get_source().stats
+
+
+def log_no_match(document_id, antholume_doc):
+    """Report an unmatched document, at most once per NO_MATCH_LOG_INTERVAL"""
+    source = get_source()
+    now = time.monotonic()
+    last = no_match_logged.get((source.name, document_id))
+    if last is not None and now - last < NO_MATCH_LOG_INTERVAL:
+        return
+    no_match_logged[(source.name, document_id)] = now
+    log.info("%s: No match for: '%s' by '%s'", source.name, antholume_doc['title'] or antholume_doc['id'],
+             antholume_doc['author'] or 'Unknown')
+
+
+class AntholumeReader:
+    """Read-only access to antholume.db that streams rows in short, separate queries"""
+
+    def __init__(self, path):
+        uri = f'file:{quote(path)}?mode=ro'
+        if ANTHOLUME_IMMUTABLE:
+            uri += '&immutable=1'
+        # Autocommit: each SELECT's snapshot ends as soon as its rows are fetched
+        # A source's cycles may run on different scheduler threads, never two at once
+        self.conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+        self.conn.execute(f'PRAGMA cache_size = -{ANTHOLUME_CACHE_KB}')
+        self.conn.execute(f'PRAGMA mmap_size = {ANTHOLUME_MMAP_SIZE}')
+        self.conn.execute('PRAGMA query_only = 1')
+
+    def _chunks(self, query, key_index, start_key):
+        """Run a `WHERE key > ? ORDER BY key LIMIT ?` query until it runs dry"""
+        last_key = start_key
+        while True:
+            cursor = self.conn.execute(query, (last_key, READ_CHUNK_SIZE))
+            rows = cursor.fetchmany(READ_CHUNK_SIZE)
+            cursor.close()
+            if not rows:
+                return
+            yield rows
+            last_key = rows[-1][key_index]
+
+    def iter_activities(self, after_id):
+        """New activities with document info, in id order, as lists of rows"""
+        return self._chunks("""
+            SELECT a.id, a.document_id, a.start_time, a.duration,
+                   a.start_percentage, a.end_percentage,
+                   d.title, d.author, d.md5, d.filepath, d.id as doc_id
+            FROM activity a
+            JOIN documents d ON a.document_id = d.id
+            WHERE a.id > ?
+            ORDER BY a.id ASC
+            LIMIT ?
+        """, 0, after_id)
+
+    def iter_progress(self):
+        """Document progress with full document info, as lists of rows"""
+        for rows in self._chunks("""
+            SELECT dp.rowid, dp.document_id, dp.percentage, dp.progress, dp.device_id,
+                   d.title, d.author, d.md5, d.filepath, d.id as doc_id
+            FROM document_progress dp
+            JOIN documents d ON dp.document_id = d.id
+            WHERE dp.rowid > ?
+            ORDER BY dp.rowid
+            LIMIT ?
+        """, 0, 0):
+            yield [row[1:] for row in rows]
 
+    def max_activity_id(self):
+        return self.conn.execute("SELECT MAX(id) FROM activity").fetchone()[0] or 0
 
-def get_antholume_connection():
-    return sqlite3.connect(ANTHOLUME_DB)
+    def close(self):
+        self.conn.close()
+
+
+def get_antholume_reader(path=None):
+    return AntholumeReader(path or ANTHOLUME_DB)
 
 
 def get_booklore_connection():
@@ -46,11 +276,130 @@ def get_booklore_connection():
     )
 
 
+class BridgeSession:
+    """
+    Connections shared by both sync phases and kept open across cycles.
+    The BookLore connection is pinged (and reconnected) before each use;
+    reset() drops everything after an error so the next cycle starts clean.
+    """
+
+    def __init__(self, antholume_db=None):
+        self.antholume_db = antholume_db
+        self.booklore = None
+        self.antholume = None
+
+    def booklore_connection(self):
+        if self.booklore is not None:
+            try:
+                self.booklore.ping(reconnect=True)
+                return self.booklore
+            except Exception as e:
+                log.warning("BookLore connection lost (%s), reconnecting", e)
+                self._close_booklore()
+        self.booklore = get_booklore_connection()
+        return self.booklore
+
+    def antholume_reader(self):
+        if self.antholume is None:
+            self.antholume = get_antholume_reader(self.antholume_db)
+        return self.antholume
+
+    def _close_booklore(self):
+        if self.booklore is not None:
+            try:
+                self.booklore.close()
+            except Exception:
+                pass
+            self.booklore = None
+
+    def reset(self):
+        """Roll back and drop all connections"""
+        if self.booklore is not None:
+            try:
+                self.booklore.rollback()
+            except Exception:
+                pass
+        self._close_booklore()
+        if self.antholume is not None:
+            try:
+                self.antholume.close()
+            except Exception:
+                pass
+            self.antholume = None
+
+    close = reset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SyncSource:
+    """One AnthoLume database synced into one BookLore user, with its own connections and state"""
+
+    def __init__(self, name, antholume_db, user_id, state_dir=None):
+        self.name = name
+        self.antholume_db = antholume_db
+        self.user_id = user_id
+        if state_dir is None:
+            self.state_file = SYNC_STATE_FILE
+            self.match_cache_file = MATCH_CACHE_FILE
+            self.progress_state_file = PROGRESS_STATE_FILE
+        else:
+            os.makedirs(state_dir, exist_ok=True)
+            self.state_file = os.path.join(state_dir, os.path.basename(SYNC_STATE_FILE))
+            self.match_cache_file = os.path.join(state_dir, os.path.basename(MATCH_CACHE_FILE))
+            self.progress_state_file = os.path.join(state_dir, os.path.basename(PROGRESS_STATE_FILE))
+        self.session = BridgeSession(antholume_db)
+        self.match_cache = None
+        self.progress_watermarks = None
+        self.stats = CycleStats()
+        self.newest_session_start = None
+
+
+def get_sources():
+    """Configured sources; without SYNC_SOURCES, the single ANTHOLUME_DB -> BOOKLORE_USER_ID one"""
+    global sources
+    if sources is None:
+        if not SYNC_SOURCES.strip():
+            sources = [SyncSource(f'user{BOOKLORE_USER_ID}', ANTHOLUME_DB, BOOKLORE_USER_ID)]
+        else:
+            sources = []
+            names = set()
+            for entry in SYNC_SOURCES.split(','):
+                path, user_id = entry.strip().rsplit(':', 1)
+                name = f'user{int(user_id)}'
+                if name in names:
+                    name = f'{name}-{len(sources) + 1}'
+                names.add(name)
+                state_dir = os.path.join(os.path.dirname(SYNC_STATE_FILE), name)
+                sources.append(SyncSource(name, path, int(user_id), state_dir))
+    return sources
+
+
+def get_source():
+    """The source the current thread is syncing (the first one outside using_source)"""
+    return getattr(active, 'source', None) or get_sources()[0]
+
+
+@contextmanager
+def using_source(source):
+    previous = getattr(active, 'source', None)
+    active.source = source
+    try:
+        yield source
+    finally:
+        active.source = previous
+
+
 def get_last_sync_id():
     """Get the last synced activity ID"""
+    state_file = get_source().state_file
     try:
-        if os.path.exists(SYNC_STATE_FILE):
-            with open(SYNC_STATE_FILE, 'r') as f:
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
                 return int(f.read().strip())
     except:
         pass
@@ -58,10 +407,20 @@ def get_last_sync_id():
 
 
 def save_last_sync_id(activity_id):
-    """Save the last synced activity ID"""
-    os.makedirs(os.path.dirname(SYNC_STATE_FILE), exist_ok=True)
-    with open(SYNC_STATE_FILE, 'w') as f:
-        f.write(str(activity_id))
+    """Save the last synced activity ID (atomically, so a crash never leaves a torn file)"""
+    state_file = get_source().state_file
+    state_dir = os.path.dirname(state_file)
+    os.makedirs(state_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix='.sync_state.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(activity_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, state_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
 def normalize_text(text):
@@ -83,15 +442,282 @@ def normalize_text(text):
     return text
 
 
-def similarity(a, b):
-    """Calculate similarity ratio between two strings"""
-    return SequenceMatcher(None, normalize_text(a), normalize_text(b)).ratio()
-
+# AnthoLume titles/authors/filenames repeat across activities and cycles
+normalize_doc_text = lru_cache(maxsize=8192)(normalize_text)
+
+
+def normalized_similarity(a, b):
+    """Similarity ratio between two already-normalized strings"""
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def trigrams(text):
+    """Character trigrams of normalized text with their counts, padded so short strings still have some"""
+    padded = f'  {text}  '
+    return collections.Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def ratio_ceiling(shared, len_a, len_b):
+    """Upper bound of SequenceMatcher's ratio for two strings sharing `shared` padded trigrams"""
+    total = len_a + len_b
+    if not total:
+        return 1.0
+    # An unmatched char spoils at most 3 trigrams of its string and a gap in the
+    # other string 2 more, so shared >= 5 * matches - 2 * total + 2
+    matches = min(len_a, len_b, (shared + 2 * total - 2) // 5)
+    return 2.0 * matches / total
+
+
+class Book:
+    """BookLore book as kept in book_cache, with match keys normalized once at load"""
+    __slots__ = ('title', 'authors', 'filenames', 'hashes',
+                 'norm_title', 'norm_authors', 'norm_filenames', 'hashes_lower')
+
+    def __init__(self, title, authors, filenames, hashes):
+        self.title = title
+        self.authors = authors
+        self.filenames = filenames
+        self.hashes = hashes
+        # None means the field is missing, '' that it normalized to nothing
+        self.norm_title = normalize_text(title) if title else None
+        self.norm_authors = normalize_text(authors) if authors else None
+        self.norm_filenames = tuple(normalize_text(bf) for bf in filenames if bf)
+        self.hashes_lower = tuple(h.lower() for h in hashes)
+
+
+class BookIndex:
+    """
+    Lookup structures over book_cache so find_booklore_book doesn't scan the library.
+
+    The fuzzy scorer first looks at books sharing a trigram with the document.
+    A title similarity above 0.8 always implies a shared padded trigram, but
+    an author and a filename made of short fragments can pass their
+    thresholds without one, so unshared_bounds covers the remaining books
+    whenever they could still win. Results are the same as scoring every
+    book. Postings keep each trigram's count, which score_bounds turns into
+    a cap on every similarity.
+    """
+
+    def __init__(self, books):
+        self.books = books
+        self.version = 0  # bumped on every change, for structures derived from the index
+        self.by_hash = defaultdict(set)         # exact hash -> book ids
+        self.by_prefix16 = defaultdict(set)     # lowercased 16-char hash prefix -> book ids
+        self.by_prefix8 = defaultdict(set)      # lowercased 8-char (or shorter) hash prefix -> book ids
+        self.title_grams = defaultdict(dict)     # trigram -> {book id: count}
+        self.author_grams = defaultdict(dict)
+        self.filename_grams = defaultdict(dict)  # count in the book's filename using it most
+        self.with_filenames = set()
+        self.by_author = defaultdict(set)        # normalized authors -> book ids
+        self.max_book_id = 0
+        for book_id, book in books.items():
+            self.add(book_id, book)
+
+    def add(self, book_id, book):
+        self.version += 1
+        self.max_book_id = max(self.max_book_id, book_id)
+        for h, h_lower in zip(book.hashes, book.hashes_lower):
+            self.by_hash[h].add(book_id)
+            self.by_prefix8[h_lower[:8]].add(book_id)
+            if len(h_lower) >= 16:
+                self.by_prefix16[h_lower[:16]].add(book_id)
+        if book.norm_title is not None:
+            for g, count in trigrams(book.norm_title).items():
+                self.title_grams[g][book_id] = count
+        if book.norm_authors is not None:
+            self.by_author[book.norm_authors].add(book_id)
+            for g, count in trigrams(book.norm_authors).items():
+                self.author_grams[g][book_id] = count
+        if book.norm_filenames:
+            self.with_filenames.add(book_id)
+        for norm_fn in book.norm_filenames:
+            for g, count in trigrams(norm_fn).items():
+                postings = self.filename_grams[g]
+                postings[book_id] = max(postings.get(book_id, 0), count)
+
+    def remove(self, book_id, book):
+        """Drop a book previously passed to add()"""
+        def discard(postings, key):
+            ids = postings.get(key)
+            if ids is not None:
+                if isinstance(ids, set):
+                    ids.discard(book_id)
+                else:
+                    ids.pop(book_id, None)
+                if not ids:
+                    del postings[key]
+
+        self.version += 1
+        for h, h_lower in zip(book.hashes, book.hashes_lower):
+            discard(self.by_hash, h)
+            discard(self.by_prefix8, h_lower[:8])
+            discard(self.by_prefix16, h_lower[:16])
+        if book.norm_title is not None:
+            for g in trigrams(book.norm_title):
+                discard(self.title_grams, g)
+        if book.norm_authors is not None:
+            discard(self.by_author, book.norm_authors)
+            for g in trigrams(book.norm_authors):
+                discard(self.author_grams, g)
+        for norm_fn in book.norm_filenames:
+            for g in trigrams(norm_fn):
+                discard(self.filename_grams, g)
+        self.with_filenames.discard(book_id)
+
+    def find_md5(self, md5):
+        """Lowest book id carrying this exact hash"""
+        ids = self.by_hash.get(md5)
+        return min(ids) if ids else None
+
+    def find_prefix16(self, doc_id):
+        """Lowest book id whose hash shares the first 16 chars with doc_id"""
+        if len(doc_id) < 16:
+            return None
+        ids = self.by_prefix16.get(doc_id.lower()[:16])
+        return min(ids) if ids else None
+
+    def hash_prefix_ids(self, doc_id):
+        """Books with a hash that shares its first 8 chars with doc_id (or prefixes a shorter one)"""
+        found = set()
+        doc_lower = doc_id.lower()
+        # Hashes that are a prefix of the doc id (keys are at most 8 chars)
+        for end in range(1, min(len(doc_lower), 8) + 1):
+            found.update(self.by_prefix8.get(doc_lower[:end], ()))
+        # Hashes the (short) doc id is a prefix of
+        if len(doc_lower) < 8:
+            for key, ids in self.by_prefix8.items():
+                if key.startswith(doc_lower):
+                    found.update(ids)
+        return found
+
+    def doc_id_filename_ids(self, doc_id):
+        """Books with a normalized filename containing the first 8 chars of doc_id"""
+        needle = doc_id.lower()[:8]
+        if len(needle) >= 3:
+            postings = [self.filename_grams.get(needle[i:i + 3], {}) for i in range(len(needle) - 2)]
+            possible = min(postings, key=len)
+        else:
+            possible = self.with_filenames
+        return {book_id for book_id in possible
+                if any(needle in norm_fn for norm_fn in self.books[book_id].norm_filenames)}
+
+    def candidates(self, norm_title, norm_author, norm_filename, doc_id):
+        """Book ids that could score anything meaningful in fuzzy matching, in id order"""
+        found = set()
+        for text, grams in ((norm_title, self.title_grams),
+                            (norm_author, self.author_grams),
+                            (norm_filename, self.filename_grams)):
+            if text is not None:
+                for g in trigrams(text):
+                    found.update(grams.get(g, ()))
 
-def load_booklore_books(cursor):
-    """Load all BookLore books into cache"""
-    global book_cache
-    cursor.execute("""
+        if doc_id:
+            found.update(self.hash_prefix_ids(doc_id))
+            found.update(self.doc_id_filename_ids(doc_id))
+
+        return sorted(found)
+
+    @staticmethod
+    def shared_trigrams(text, postings):
+        """{book id: trigrams shared with text}, counted with multiplicity"""
+        shared = collections.Counter()
+        for g, count in trigrams(text).items():
+            posted = postings.get(g)
+            if not posted:
+                continue
+            if count == 1:
+                shared.update(posted.keys())
+            else:
+                for book_id, posted_count in posted.items():
+                    shared[book_id] += min(count, posted_count)
+        return shared
+
+    def score_bounds(self, norm_title, norm_author, norm_filename, doc_id):
+        """
+        {book id: upper bound of score_book} for the candidates that could still
+        reach MATCH_MIN_SCORE. Shared trigram counts and lengths cap each
+        similarity (see ratio_ceiling), so a title needs several shared
+        trigrams to pass 0.8 and far longer or shorter authors and filenames
+        can't pass theirs.
+        """
+        title_shared = author_shared = fn_shared = {}
+        if norm_title is not None:
+            title_shared = self.shared_trigrams(norm_title, self.title_grams)
+        if norm_author is not None:
+            author_shared = self.shared_trigrams(norm_author, self.author_grams)
+        if norm_filename is not None:
+            fn_shared = self.shared_trigrams(norm_filename, self.filename_grams)
+        filename_ids = hash_ids = set()
+        if doc_id:
+            filename_ids = self.doc_id_filename_ids(doc_id)
+            hash_ids = self.hash_prefix_ids(doc_id)
+
+        bounds = {}
+        for book_id in set(title_shared).union(author_shared, fn_shared, filename_ids, hash_ids):
+            book = self.books[book_id]
+            # Summed in score_book's order, so a bound is never below the real score
+            bound = 0.0
+            if norm_title is not None and book.norm_title is not None:
+                ub = ratio_ceiling(title_shared.get(book_id, 0), len(norm_title), len(book.norm_title))
+                if ub > TITLE_THRESHOLD:
+                    bound += ub * TITLE_WEIGHT
+            if norm_author is not None and book.norm_authors is not None:
+                ub = ratio_ceiling(author_shared.get(book_id, 0), len(norm_author), len(book.norm_authors))
+                if ub > AUTHOR_THRESHOLD:
+                    bound += ub * AUTHOR_WEIGHT
+            if norm_filename is not None and book.norm_filenames:
+                # The posted count is the most any one filename shares
+                shared = fn_shared.get(book_id, 0)
+                ub = max(ratio_ceiling(shared, len(norm_filename), len(norm_fn)) for norm_fn in book.norm_filenames)
+                if ub > FILENAME_THRESHOLD:
+                    bound += ub * FILENAME_WEIGHT
+            if book_id in filename_ids:
+                bound += DOC_ID_FILENAME_BONUS
+            if book_id in hash_ids:
+                bound += HASH_PREFIX_BONUS
+            if bound >= MATCH_MIN_SCORE:
+                bounds[book_id] = bound
+        return bounds
+
+    def unshared_bounds(self, norm_author, norm_filename, shared_ids, floor):
+        """
+        {book id: upper bound of score_book} for the books outside shared_ids
+        (those sharing a trigram or a doc id bonus with the document) that
+        could still reach floor. Their titles can't pass and their author and
+        filename similarities stay below 0.8, so only books whose author
+        actually passes are bounded; each distinct author is compared once.
+        """
+        bounds = {}
+        # quick_ratio only counts characters, so it bounds either argument order
+        # and keeps the document's counts between authors
+        quick = SequenceMatcher(None, '', norm_author)
+        for authors, ids in self.by_author.items():
+            if ratio_ceiling(0, len(norm_author), len(authors)) <= AUTHOR_THRESHOLD or ids <= shared_ids:
+                continue
+            quick.set_seq1(authors)
+            if quick.quick_ratio() <= AUTHOR_THRESHOLD:
+                continue
+            author_sim = normalized_similarity(norm_author, authors)
+            if author_sim <= AUTHOR_THRESHOLD:
+                continue
+            for book_id in ids - shared_ids:
+                bound = author_sim * AUTHOR_WEIGHT
+                norm_filenames = self.books[book_id].norm_filenames
+                if norm_filename is not None and norm_filenames:
+                    ub = max(ratio_ceiling(0, len(norm_filename), len(norm_fn)) for norm_fn in norm_filenames)
+                    if ub > FILENAME_THRESHOLD:
+                        bound += ub * FILENAME_WEIGHT
+                if bound >= floor:
+                    bounds[book_id] = bound
+        return bounds
+
+
+def fetch_booklore_books(cursor, book_ids=None):
+    """Fetch BookLore books (all of them, or just book_ids) as Book records"""
+    id_filter = ''
+    if book_ids is not None:
+        id_filter = 'AND b.id IN (' + ', '.join(['%s'] * len(book_ids)) + ')'
+    cursor.execute(f"""
         SELECT b.id, bm.title, GROUP_CONCAT(DISTINCT a.name SEPARATOR ', ') as authors,
                GROUP_CONCAT(DISTINCT bf.file_name SEPARATOR '|') as filenames,
                GROUP_CONCAT(DISTINCT COALESCE(bf.initial_hash, bf.current_hash) SEPARATOR '|') as hashes
@@ -100,23 +726,111 @@ def load_booklore_books(cursor):
         LEFT JOIN book_metadata_author_mapping bam ON bm.book_id = bam.book_id
         LEFT JOIN author a ON bam.author_id = a.id
         LEFT JOIN book_file bf ON b.id = bf.book_id
-        WHERE b.deleted = 0
+        WHERE b.deleted = 0 {id_filter}
         GROUP BY b.id, bm.title
-    """)
+        ORDER BY b.id
+    """, book_ids)
 
-    book_cache = {}
+    books = {}
     for row in cursor.fetchall():
-        book_cache[row['id']] = {
-            'title': row['title'] or '',
-            'authors': row['authors'] or '',
-            'filenames': (row['filenames'] or '').split('|'),
-            'hashes': [h for h in (row['hashes'] or '').split('|') if h]
-        }
-    print(f"[{datetime.now()}] Loaded {len(book_cache)} books from BookLore")
+        books[row['id']] = Book(
+            title=row['title'] or '',
+            authors=row['authors'] or '',
+            filenames=tuple((row['filenames'] or '').split('|')),
+            hashes=tuple(h for h in (row['hashes'] or '').split('|') if h)
+        )
+    return books
+
+
+def fetch_booklore_digests(cursor):
+    """Cheap per-book checksum of everything fetch_booklore_books reads, without GROUP_CONCAT"""
+    cursor.execute("""
+        SELECT b.id, CONCAT_WS(':', CRC32(COALESCE(bm.title, '')), COALESCE(au.crc, 0), COALESCE(f.crc, 0)) as digest
+        FROM book b
+        JOIN book_metadata bm ON b.id = bm.book_id
+        LEFT JOIN (
+            SELECT bam.book_id, SUM(CRC32(a.name)) as crc
+            FROM book_metadata_author_mapping bam
+            JOIN author a ON bam.author_id = a.id
+            GROUP BY bam.book_id
+        ) au ON b.id = au.book_id
+        LEFT JOIN (
+            SELECT book_id, SUM(CRC32(CONCAT_WS('|', file_name, COALESCE(initial_hash, current_hash)))) as crc
+            FROM book_file
+            GROUP BY book_id
+        ) f ON b.id = f.book_id
+        WHERE b.deleted = 0
+    """)
+    return {row['id']: row['digest'] for row in cursor.fetchall()}
+
+
+def load_booklore_books(cursor):
+    """Load all BookLore books into cache"""
+    global book_cache, book_index, book_digests, catalogue_loaded_at
+    book_digests = fetch_booklore_digests(cursor)
+    book_cache = fetch_booklore_books(cursor)
+    book_index = BookIndex(book_cache)
+    catalogue_loaded_at = time.time()
+    log.info("Loaded %d books from BookLore", len(book_cache))
+
+
+def refresh_booklore_books(cursor):
+    """Bring the book cache up to date, fetching only books added, changed or deleted since the last load"""
+    global book_digests
+    if book_index is None or time.time() - catalogue_loaded_at > CATALOGUE_RELOAD_INTERVAL:
+        load_booklore_books(cursor)
+        return
+
+    digests = fetch_booklore_digests(cursor)
+    removed = [book_id for book_id in book_digests if book_id not in digests]
+    changed = [book_id for book_id, digest in digests.items() if book_digests.get(book_id) != digest]
+
+    for book_id in removed:
+        book_index.remove(book_id, book_cache.pop(book_id))
+
+    for start in range(0, len(changed), 1000):
+        chunk = changed[start:start + 1000]
+        fresh = fetch_booklore_books(cursor, chunk)
+        for book_id in chunk:
+            old = book_cache.pop(book_id, None)
+            if old is not None:
+                book_index.remove(book_id, old)
+            if book_id in fresh:
+                book_cache[book_id] = fresh[book_id]
+                book_index.add(book_id, fresh[book_id])
+            else:
+                # Deleted between the two queries
+                digests.pop(book_id, None)
+
+    book_digests = digests
+    if removed or changed:
+        log.info("Refreshed BookLore books: %d added/changed, %d removed, %d total",
+                 len(changed), len(removed), len(book_cache))
+
+
+def confirm_best_match(bounds, norm_title, norm_author, norm_filename, doc_id, best_match=None, best_score=0):
+    """
+    Score {book id: upper bound} books best bound first, like VectorScorer,
+    until none can beat (best_match, best_score); lowest id wins ties
+    """
+    for book_id in sorted(bounds, key=lambda b: (-bounds[b], b)):
+        if bounds[book_id] < best_score or \
+                (bounds[book_id] == best_score and best_match is not None and book_id > best_match):
+            break
+        score = score_book(book_cache[book_id], norm_title, norm_author, norm_filename, doc_id)
+        if score > best_score or (score == best_score and best_match is not None and book_id < best_match):
+            best_score = score
+            best_match = book_id
+    return best_match, best_score
 
 
 def find_booklore_book(antholume_doc):
     """Find matching BookLore book for an AnthoLume document"""
+    return find_booklore_match(antholume_doc)[0]
+
+
+def find_booklore_match(antholume_doc):
+    """(book_id, method) for an AnthoLume document; method is md5, hash_prefix, fuzzy or miss"""
     title = antholume_doc.get('title', '') or ''
     author = antholume_doc.get('author', '') or ''
     filepath = antholume_doc.get('filepath', '') or ''
@@ -128,75 +842,357 @@ def find_booklore_book(antholume_doc):
 
     # First try: exact MD5 match (highest priority)
     if md5:
-        for book_id, book in book_cache.items():
-            if md5 in book.get('hashes', []):
-                print(f"[{datetime.now()}] MD5 match: '{title or doc_id}' -> '{book.get('title', 'Unknown')}' (hash: {md5[:8]}...)")
-                return book_id
+        book_id = book_index.find_md5(md5)
+        if book_id is not None:
+            log.debug("MD5 match: '%s' -> '%s' (hash: %s...)", title or doc_id, book_cache[book_id].title, md5[:8])
+            return book_id, 'md5'
 
     # Second try: hash prefix match (KOReader partial MD5 vs BookLore full hash)
     # doc_id in AnthoLume is the partial MD5 from KOReader
     if doc_id:
-        doc_id_lower = doc_id.lower()
-        for book_id, book in book_cache.items():
-            for h in book.get('hashes', []):
-                if h:
-                    h_lower = h.lower()
-                    # Check if one is prefix of the other (at least 16 chars match)
-                    if len(doc_id_lower) >= 16 and len(h_lower) >= 16:
-                        if doc_id_lower.startswith(h_lower[:16]) or h_lower.startswith(doc_id_lower[:16]):
-                            print(f"[{datetime.now()}] Hash prefix match: '{title or doc_id[:16]}...' -> '{book.get('title', 'Unknown')}'")
-                            return book_id
-
-    best_match = None
-    best_score = 0
-
-    for book_id, book in book_cache.items():
-        score = 0
-
-        # Try exact title match (normalized)
-        if title and book['title']:
-            title_sim = similarity(title, book['title'])
-            if title_sim > 0.8:
-                score += title_sim * 50
-
-        # Try author match
-        if author and book['authors']:
-            author_sim = similarity(author, book['authors'])
-            if author_sim > 0.5:
-                score += author_sim * 30
-
-        # Try filename match
-        if filename:
-            for bf in book['filenames']:
-                if bf:
-                    fn_sim = similarity(filename, bf)
-                    if fn_sim > 0.6:
-                        score += fn_sim * 40
-                        break
-
-        # If document ID contains part of filename or hash
-        if doc_id:
-            for bf in book['filenames']:
-                if bf and doc_id[:8].lower() in normalize_text(bf):
-                    score += 20
-                    break
-            # Also check if doc_id matches any hash prefix
-            for h in book.get('hashes', []):
-                if h and (doc_id.lower().startswith(h[:8].lower()) or h.lower().startswith(doc_id[:8].lower())):
-                    score += 30
-                    break
-
-        if score > best_score:
-            best_score = score
-            best_match = book_id
+        book_id = book_index.find_prefix16(doc_id)
+        if book_id is not None:
+            log.debug("Hash prefix match: '%s...' -> '%s'", title or doc_id[:16], book_cache[book_id].title)
+            return book_id, 'hash_prefix'
+
+    norm_title = normalize_doc_text(title) if title else None
+    norm_author = normalize_doc_text(author) if author else None
+    norm_filename = normalize_doc_text(filename) if filename else None
+
+    scorer = get_vector_scorer()
+    candidates = None
+    if scorer is not None:
+        candidates = book_index.candidates(norm_title, norm_author, norm_filename, doc_id)
+        best_match, best_score = scorer.best_match(candidates, norm_title, norm_author, norm_filename, doc_id)
+    else:
+        bounds = book_index.score_bounds(norm_title, norm_author, norm_filename, doc_id)
+        best_match, best_score = confirm_best_match(bounds, norm_title, norm_author, norm_filename, doc_id)
+
+    # Books sharing no trigram with the document can't pass the title threshold
+    # and stay below 0.8 on author and filename, so they only need a look while
+    # the best score is lower than that
+    unshared_ceiling = 0.8 * (AUTHOR_WEIGHT + (FILENAME_WEIGHT if norm_filename is not None else 0))
+    if norm_author is not None and max(best_score, MATCH_MIN_SCORE) < unshared_ceiling:
+        if candidates is None:
+            candidates = book_index.candidates(norm_title, norm_author, norm_filename, doc_id)
+        bounds = book_index.unshared_bounds(norm_author, norm_filename, set(candidates),
+                                            max(best_score, MATCH_MIN_SCORE))
+        best_match, best_score = confirm_best_match(bounds, norm_title, norm_author, norm_filename, doc_id,
+                                                    best_match, best_score)
 
     # Only return if we have a decent match
-    if best_score >= 40:
-        matched_book = book_cache.get(best_match, {})
-        print(f"[{datetime.now()}] Matched '{title or doc_id}' -> '{matched_book.get('title', 'Unknown')}' (score: {best_score:.1f})")
-        return best_match
+    if best_score >= MATCH_MIN_SCORE:
+        log.debug("Matched '%s' -> '%s' (score: %.1f)", title or doc_id, book_cache[best_match].title, best_score)
+        return best_match, 'fuzzy'
+
+    return None, 'miss'
+
+
+def score_book(book, norm_title, norm_author, norm_filename, doc_id):
+    """Fuzzy match score of one BookLore book against a normalized AnthoLume document"""
+    score = 0
+
+    # Try exact title match (normalized)
+    if norm_title is not None and book.norm_title is not None:
+        title_sim = normalized_similarity(norm_title, book.norm_title)
+        if title_sim > TITLE_THRESHOLD:
+            score += title_sim * TITLE_WEIGHT
+
+    # Try author match
+    if norm_author is not None and book.norm_authors is not None:
+        author_sim = normalized_similarity(norm_author, book.norm_authors)
+        if author_sim > AUTHOR_THRESHOLD:
+            score += author_sim * AUTHOR_WEIGHT
+
+    # Try filename match
+    if norm_filename is not None:
+        for norm_fn in book.norm_filenames:
+            fn_sim = normalized_similarity(norm_filename, norm_fn)
+            if fn_sim > FILENAME_THRESHOLD:
+                score += fn_sim * FILENAME_WEIGHT
+                break
+
+    # If document ID contains part of filename or hash
+    if doc_id:
+        doc_lower = doc_id.lower()
+        doc_prefix = doc_lower[:8]
+        for norm_fn in book.norm_filenames:
+            if doc_prefix in norm_fn:
+                score += DOC_ID_FILENAME_BONUS
+                break
+        # Also check if doc_id matches any hash prefix
+        for h_lower in book.hashes_lower:
+            if doc_lower.startswith(h_lower[:8]) or h_lower.startswith(doc_prefix):
+                score += HASH_PREFIX_BONUS
+                break
+
+    return score
+
+
+# Normalized text is lowercase letters, digits, '_' and spaces; everything else
+# shares buckets, which only loosens the bounds below
+CHAR_BUCKETS = 64
+if np is not None:
+    ASCII_BUCKETS = np.array([37 + cp % 27 for cp in range(128)], dtype=np.int64)
+    ASCII_BUCKETS[ord('a'):ord('z') + 1] = np.arange(26)
+    ASCII_BUCKETS[ord('0'):ord('9') + 1] = np.arange(26, 36)
+    ASCII_BUCKETS[ord(' ')] = 36
+
+
+def char_buckets(text):
+    """Bucket index of every character of text"""
+    cps = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+    return np.where(cps < 128, ASCII_BUCKETS[np.minimum(cps, 127)], 37 + cps % 27)
+
+
+def char_count_matrix(texts):
+    """(counts, lengths, present) for a list of normalized strings, None meaning absent"""
+    lengths = np.array([len(t) if t is not None else 0 for t in texts], dtype=np.int64)
+    present = np.array([t is not None for t in texts], dtype=bool)
+    buckets = char_buckets(''.join(t for t in texts if t))
+    rows = np.repeat(np.arange(len(texts)), lengths)
+    counts = np.bincount(rows * CHAR_BUCKETS + buckets, minlength=len(texts) * CHAR_BUCKETS)
+    return counts.reshape(len(texts), CHAR_BUCKETS), lengths, present
+
+
+def ratio_bounds(text, counts, lengths):
+    """Upper bound of SequenceMatcher(None, text, other).ratio() for each row of counts"""
+    doc_counts = np.bincount(char_buckets(text), minlength=CHAR_BUCKETS)
+    matches = np.minimum(counts, doc_counts).sum(axis=1)
+    total = lengths + len(text)
+    # Same arithmetic as difflib, so a bound is never below the real ratio
+    return np.where(total > 0, 2.0 * matches / np.maximum(total, 1), 1.0)
+
+
+class VectorScorer:
+    """
+    Batch fuzzy scorer over the whole catalogue. Character counts bound every
+    SequenceMatcher ratio from above (like difflib's quick_ratio), so a
+    document's candidates are bounded in one pass and score_book only
+    confirms books, best bound first, while they can still beat the best
+    score found. Picks the same book as scoring every candidate.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.version = index.version
+        books = index.books
+        ids = sorted(books)
+        ordered = [books[book_id] for book_id in ids]
+        self.ids = np.array(ids, dtype=np.int64)
+        self.slots = {book_id: slot for slot, book_id in enumerate(ids)}
+        self.title_counts, self.title_lengths, self.has_title = \
+            char_count_matrix([book.norm_title for book in ordered])
+        self.author_counts, self.author_lengths, self.has_author = \
+            char_count_matrix([book.norm_authors for book in ordered])
+        self.fn_counts, self.fn_lengths, _ = \
+            char_count_matrix([norm_fn for book in ordered for norm_fn in book.norm_filenames])
+        self.fn_per_book = np.array([len(book.norm_filenames) for book in ordered], dtype=np.int64)
+        self.fn_start = np.cumsum(self.fn_per_book) - self.fn_per_book
+
+    def bounds(self, slots, norm_title, norm_author, norm_filename, doc_id):
+        """Upper bound of score_book for each slot, accumulated in score_book's order"""
+        bound = np.zeros(len(slots))
+        if norm_title is not None:
+            ub = ratio_bounds(norm_title, self.title_counts[slots], self.title_lengths[slots])
+            bound += np.where(self.has_title[slots] & (ub > TITLE_THRESHOLD), ub * TITLE_WEIGHT, 0.0)
+        if norm_author is not None:
+            ub = ratio_bounds(norm_author, self.author_counts[slots], self.author_lengths[slots])
+            bound += np.where(self.has_author[slots] & (ub > AUTHOR_THRESHOLD), ub * AUTHOR_WEIGHT, 0.0)
+        if norm_filename is not None:
+            per_book = self.fn_per_book[slots]
+            if per_book.sum():
+                owners = np.repeat(np.arange(len(slots)), per_book)
+                rows = np.repeat(self.fn_start[slots], per_book) + \
+                    np.arange(per_book.sum()) - np.repeat(np.cumsum(per_book) - per_book, per_book)
+                ub = ratio_bounds(norm_filename, self.fn_counts[rows], self.fn_lengths[rows])
+                fn_bound = np.zeros(len(slots))
+                np.maximum.at(fn_bound, owners, np.where(ub > FILENAME_THRESHOLD, ub * FILENAME_WEIGHT, 0.0))
+                bound += fn_bound
+        if doc_id:
+            ids = self.ids[slots]
+            bound += np.where(np.isin(ids, list(self.index.doc_id_filename_ids(doc_id))), DOC_ID_FILENAME_BONUS, 0.0)
+            bound += np.where(np.isin(ids, list(self.index.hash_prefix_ids(doc_id))), HASH_PREFIX_BONUS, 0.0)
+        return bound
+
+    def best_match(self, candidates, norm_title, norm_author, norm_filename, doc_id):
+        """(book_id, score) of the best candidate, lowest id on ties; (None, 0) if none scores"""
+        best_match = None
+        best_score = 0
+        if not candidates:
+            return best_match, best_score
+
+        slots = np.array([self.slots[book_id] for book_id in candidates], dtype=np.int64)
+        bound = self.bounds(slots, norm_title, norm_author, norm_filename, doc_id)
+        ids = self.ids[slots]
+        for i in np.lexsort((ids, -bound)):
+            book_id = int(ids[i])
+            if bound[i] < MATCH_MIN_SCORE or bound[i] < best_score or \
+                    (bound[i] == best_score and best_match is not None and book_id > best_match):
+                break
+            score = score_book(self.index.books[book_id], norm_title, norm_author, norm_filename, doc_id)
+            if score > best_score or (score == best_score and best_match is not None and book_id < best_match):
+                best_score = score
+                best_match = book_id
+        return best_match, best_score
+
+
+def get_vector_scorer():
+    """VectorScorer for the current book_index, rebuilt after catalogue changes; None without numpy"""
+    global vector_scorer
+    if np is None or SCORING_ENGINE == 'python':
+        return None
+    if vector_scorer is None or vector_scorer.index is not book_index or vector_scorer.version != book_index.version:
+        vector_scorer = VectorScorer(book_index)
+    return vector_scorer
+
+
+def book_signature(book):
+    """Identity of a book's files; a cached match is dropped once this changes"""
+    return '|'.join(sorted(book.hashes))
+
+
+def document_fingerprint(antholume_doc):
+    """Hash of the AnthoLume fields matching depends on"""
+    parts = [antholume_doc.get(k) or '' for k in ('md5', 'title', 'author', 'filepath')]
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class MatchCache:
+    """SQLite-backed memory of AnthoLume document -> BookLore book decisions"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS matches (
+                doc_id TEXT PRIMARY KEY,
+                md5 TEXT,
+                fingerprint TEXT NOT NULL,
+                book_id INTEGER,
+                book_signature TEXT,
+                misses INTEGER NOT NULL DEFAULT 0,
+                retry_at REAL,
+                max_book_id INTEGER,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+        self.entries = {
+            row[0]: row[1:]
+            for row in self.conn.execute("""
+                SELECT doc_id, fingerprint, book_id, book_signature, misses, retry_at, max_book_id
+                FROM matches
+            """)
+        }
 
-    return None
+    def lookup(self, doc_id, fingerprint):
+        """Return (hit, book_id); hit is False when the document must be matched again"""
+        entry = self.entries.get(doc_id)
+        if not entry or entry[0] != fingerprint:
+            return False, None
+        _, book_id, signature, _, retry_at, max_book_id = entry
+        if book_id is not None:
+            book = book_cache.get(book_id)
+            if book is not None and book_signature(book) == signature:
+                return True, book_id
+            return False, None
+        # Remembered miss: retry once the backoff expires or new books show up
+        if time.time() < (retry_at or 0) and book_index.max_book_id <= (max_book_id or 0):
+            return True, None
+        return False, None
+
+    def store(self, doc_id, md5, fingerprint, book_id):
+        now = time.time()
+        if book_id is not None:
+            entry = (fingerprint, book_id, book_signature(book_cache[book_id]), 0, None, None)
+        else:
+            previous = self.entries.get(doc_id)
+            misses = previous[3] + 1 if previous and previous[1] is None else 1
+            delay = min(MATCH_RETRY_BASE * 2 ** (misses - 1), MATCH_RETRY_MAX)
+            entry = (fingerprint, None, None, misses, now + delay, book_index.max_book_id)
+        self.entries[doc_id] = entry
+        self.conn.execute("""
+            INSERT OR REPLACE INTO matches
+            (doc_id, md5, fingerprint, book_id, book_signature, misses, retry_at, max_book_id, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (doc_id, md5, *entry, now))
+
+    def commit(self):
+        self.conn.commit()
+
+
+def get_match_cache():
+    source = get_source()
+    if source.match_cache is None:
+        source.match_cache = MatchCache(source.match_cache_file)
+    return source.match_cache
+
+
+def get_match_pool():
+    """
+    SYNC_WORKERS forked matching processes, shared by every source and kept
+    until the catalogue changes. Workers inherit the catalogue, index and
+    scorer copy-on-write as they were at fork time.
+    """
+    global match_pool, match_pool_index
+    with match_pool_lock:
+        if match_pool is None or match_pool_index[0] is not book_index or match_pool_index[1] != book_index.version:
+            close_match_pool()
+            get_vector_scorer()
+            match_pool = ProcessPoolExecutor(SYNC_WORKERS, mp_context=multiprocessing.get_context('fork'))
+            # Fork every worker now instead of on the first batch
+            match_pool.submit(os.getpid).result()
+            match_pool_index = (book_index, book_index.version)
+        return match_pool
+
+
+def close_match_pool():
+    """Shut the matching processes down; the next parallel batch forks new ones"""
+    global match_pool
+    with match_pool_lock:
+        if match_pool is not None:
+            match_pool.shutdown(cancel_futures=True)
+            match_pool = None
+
+
+def match_documents(documents, use_cache=True):
+    """
+    {key: (book_id, method)} for a {key: antholume_doc} batch, answered from the
+    match cache when use_cache is set (method 'cached'); misses may run on
+    SYNC_WORKERS processes.
+    """
+    cache = get_match_cache() if use_cache else None
+    matches = {}
+    pending = []
+
+    for key, antholume_doc in documents.items():
+        fingerprint = document_fingerprint(antholume_doc)
+        hit, book_id = cache.lookup(antholume_doc.get('id') or '', fingerprint) if cache else (False, None)
+        if hit:
+            matches[key] = (book_id, 'cached')
+        else:
+            pending.append((key, antholume_doc, fingerprint))
+
+    docs = [antholume_doc for _, antholume_doc, _ in pending]
+    if SYNC_WORKERS > 1 and len(docs) >= PARALLEL_MATCH_MIN:
+        pool = get_match_pool()
+        try:
+            found = list(pool.map(find_booklore_match, docs, chunksize=max(1, len(docs) // (SYNC_WORKERS * 4))))
+        except BrokenProcessPool:
+            close_match_pool()
+            raise
+    else:
+        found = [find_booklore_match(antholume_doc) for antholume_doc in docs]
+
+    stats = get_cycle_stats()
+    stats.count('match_cache_hits', len(documents) - len(pending))
+    for (key, antholume_doc, fingerprint), (book_id, method) in zip(pending, found):
+        if cache:
+            cache.store(antholume_doc.get('id') or '', antholume_doc.get('md5'), fingerprint, book_id)
+        matches[key] = (book_id, method)
+        stats.count(f'match_{method}')
+    return matches
 
 
 def get_book_type(title, filepath):
@@ -210,237 +1206,728 @@ def get_book_type(title, filepath):
     return 'EPUB'
 
 
-def sync_activities():
+def resolve_documents(resolved, documents, use_cache=True):
+    """
+    Match the {document_id: antholume_doc} documents not yet in this cycle's
+    `resolved` map and record them as document_id -> (book_id, book_type, method).
+    Returns the documents resolved by this call.
+    """
+    pending = {document_id: antholume_doc for document_id, antholume_doc in documents.items()
+               if document_id not in resolved}
+    with get_cycle_stats().timed('match'):
+        matches = match_documents(pending, use_cache)
+    for document_id, antholume_doc in pending.items():
+        book_id, method = matches[document_id]
+        book_type = get_book_type(antholume_doc['title'], antholume_doc['filepath'])
+        resolved[document_id] = (book_id, book_type, method)
+    return pending
+
+
+def parse_start_time(start_time):
+    """AnthoLume activity start_time (ISO string, SQL datetime or epoch) as a datetime"""
+    try:
+        if isinstance(start_time, str):
+            if 'T' in start_time:
+                return datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+            return datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
+        return datetime.fromtimestamp(start_time)
+    except:
+        return datetime.now()
+
+
+def session_key(document_id, activity_id):
+    """start_location of the reading_sessions row synced from an AnthoLume activity"""
+    return f'{SESSION_KEY_PREFIX}{document_id}:{activity_id}'
+
+
+def prefetch_session_starts(cursor, book_windows):
+    """
+    Start times of existing reading_sessions per book, limited to each book's
+    (earliest, latest) activity window widened by DUPLICATE_WINDOW, and the
+    session keys among them. A row's own start time is inside its window, so
+    every already-synced activity of these books shows up in the keys.
+    """
+    starts = defaultdict(list)
+    keys = set()
+    book_ids = list(book_windows)
+    for i in range(0, len(book_ids), PREFETCH_BATCH_SIZE):
+        chunk = book_ids[i:i + PREFETCH_BATCH_SIZE]
+        ranges = ' OR '.join(['(book_id = %s AND start_time BETWEEN %s AND %s)'] * len(chunk))
+        params = [get_source().user_id]
+        for book_id in chunk:
+            first, last = book_windows[book_id]
+            params += [book_id, first - DUPLICATE_WINDOW, last + DUPLICATE_WINDOW]
+        cursor.execute(f"""
+            SELECT book_id, start_time, start_location FROM reading_sessions
+            WHERE user_id = %s AND ({ranges})
+        """, params)
+        for row in cursor.fetchall():
+            starts[row['book_id']].append(row['start_time'])
+            keys.add(row['start_location'])
+    for times in starts.values():
+        times.sort()
+    return starts, keys
+
+
+def is_duplicate_session(sorted_starts, start_dt):
+    """True if a start time within DUPLICATE_WINDOW of start_dt is already in sorted_starts"""
+    i = bisect.bisect_left(sorted_starts, start_dt)
+    if i < len(sorted_starts) and sorted_starts[i] - start_dt < DUPLICATE_WINDOW:
+        return True
+    return i > 0 and start_dt - sorted_starts[i - 1] < DUPLICATE_WINDOW
+
+
+def server_now(cursor):
+    """
+    BookLore's NOW(). executemany only batches into one statement when VALUES
+    is all placeholders, so bulk writes pass this instead of NOW() per row.
+    """
+    cursor.execute("SELECT NOW() as now")
+    return cursor.fetchone()['now']
+
+
+def insert_reading_sessions(cursor, rows):
+    """Bulk insert reading_sessions rows in INSERT_BATCH_SIZE chunks"""
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        created_at = server_now(cursor)
+        cursor.executemany("""
+            INSERT INTO reading_sessions
+            (user_id, book_id, book_type, start_time, end_time, duration_seconds,
+             start_progress, end_progress, progress_delta, start_location, end_location, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, [row + (created_at,) for row in rows[i:i + INSERT_BATCH_SIZE]])
+
+
+def plan_activity_chunk(cursor, activities, resolved, use_cache=True, planned=None):
+    """
+    Match and dedupe one chunk of AnthoLume activities without writing anything.
+    Returns (new_documents, sessions, skipped): the documents first resolved by
+    this chunk, (activity_id, document_id, row) reading_sessions rows to insert
+    and (activity_id, document_id, reason) for the rest. `planned` carries
+    {book_id: sorted starts} of rows planned by earlier chunks that were never
+    inserted, so they still count as duplicates.
+    """
+    user_id = get_source().user_id
+    sessions = []
+    skipped = []
+    book_windows = {}
+
+    # Document pass: each distinct document is matched once per cycle
+    documents = {}
+    for activity in activities:
+        document_id, title, author, md5, filepath, doc_id = (activity[1],) + activity[6:]
+        if document_id not in documents:
+            documents[document_id] = {
+                'id': doc_id,
+                'title': title,
+                'author': author,
+                'md5': md5,
+                'filepath': filepath
+            }
+    new_documents = resolve_documents(resolved, documents, use_cache)
+
+    # Activity pass
+    for activity in activities:
+        (activity_id, document_id, start_time, duration,
+         start_percentage, end_percentage, title, author, md5, filepath, doc_id) = activity
+
+        book_id, book_type, _ = resolved[document_id]
+        if not book_id:
+            skipped.append((activity_id, document_id, 'unmatched'))
+            continue
+
+        # MariaDB compares wall-clock values, so drop any UTC offset for deduping
+        start_dt = parse_start_time(start_time)
+        start_key = start_dt.replace(tzinfo=None)
+
+        # Calculate end time
+        duration_secs = int(duration or 0)
+        end_dt = start_dt + timedelta(seconds=duration_secs)
+
+        # Calculate progress
+        start_pct = float(start_percentage or 0) * 100
+        end_pct = float(end_percentage or 0) * 100
+        progress_delta = end_pct - start_pct
+
+        sessions.append((start_key, activity_id, document_id, (
+            user_id, book_id, book_type, start_dt, end_dt, duration_secs,
+            start_pct, end_pct, progress_delta,
+            session_key(document_id, activity_id), f'{SESSION_KEY_PREFIX}{document_id}'
+        )))
+        first, last = book_windows.get(book_id, (start_key, start_key))
+        book_windows[book_id] = (min(first, start_key), max(last, start_key))
+
+    stats = get_cycle_stats()
+
+    # Check for duplicates against BookLore and earlier sessions in this chunk
+    with stats.timed('dedupe'):
+        existing_starts, existing_keys = prefetch_session_starts(cursor, book_windows)
+        if planned:
+            for book_id in book_windows:
+                if book_id in planned:
+                    existing_starts[book_id] = sorted(existing_starts[book_id] + planned[book_id])
+        new_sessions = []
+        already_synced = 0
+        for start_key, activity_id, document_id, row in sessions:
+            book_starts = existing_starts[row[1]]
+            # Exact: this activity was inserted before (e.g. the watermark was not saved)
+            if row[9] in existing_keys:
+                skipped.append((activity_id, document_id, 'already_synced'))
+                already_synced += 1
+                continue
+            if is_duplicate_session(book_starts, start_key):
+                skipped.append((activity_id, document_id, 'duplicate'))
+                continue
+            bisect.insort(book_starts, start_key)
+            if planned is not None:
+                bisect.insort(planned[row[1]], start_key)
+            new_sessions.append((activity_id, document_id, row))
+    stats.count('already_synced', already_synced)
+    stats.count('duplicates_skipped', len(sessions) - len(new_sessions) - already_synced)
+
+    return new_documents, new_sessions, skipped
+
+
+def sync_activity_chunk(cursor, activities, resolved):
+    """Match, dedupe and insert one chunk of AnthoLume activities; returns sessions inserted"""
+    new_documents, sessions, _ = plan_activity_chunk(cursor, activities, resolved)
+    for document_id, antholume_doc in new_documents.items():
+        if not resolved[document_id][0]:
+            log_no_match(document_id, antholume_doc)
+
+    new_rows = [row for _, _, row in sessions]
+    with get_cycle_stats().timed('insert'):
+        insert_reading_sessions(cursor, new_rows)
+    note_newest_session(*(row[3] for row in new_rows))
+
+    if log.isEnabledFor(logging.DEBUG):
+        for row in new_rows:
+            log.debug("Synced: '%s' - %ss, %.1f%% progress", book_cache[row[1]].title, row[5], row[8])
+
+    return len(new_rows)
+
+
+def note_newest_session(*start_dts):
+    """Track the newest synced session start for the newest-session-age metric"""
+    source = get_source()
+    try:
+        # Naive values are BookLore's wall clock; compare them as local time
+        start_dts = [dt if dt.tzinfo else dt.astimezone() for dt in start_dts if dt is not None]
+        if not start_dts:
+            return
+        newest = max(start_dts)
+        if source.newest_session_start is None or newest > source.newest_session_start:
+            source.newest_session_start = newest
+    except Exception as e:
+        # Metrics bookkeeping must never fail the sync itself
+        log.warning("Could not track the newest session start: %s", e)
+
+
+def load_newest_session(cursor):
+    """Seed the newest-session-age metric from BookLore after a restart"""
+    cursor.execute("""
+        SELECT MAX(start_time) as newest FROM reading_sessions
+        WHERE user_id = %s AND start_location LIKE %s
+    """, (get_source().user_id, SESSION_KEY_PREFIX + '%'))
+    note_newest_session(cursor.fetchone()['newest'])
+
+
+def sync_activities(session, resolved, refresh=True):
     """Sync reading activities from AnthoLume to BookLore"""
     last_sync_id = get_last_sync_id()
-    print(f"[{datetime.now()}] Starting activity sync from ID {last_sync_id}")
+    stats = get_cycle_stats()
+    log.debug("Starting activity sync from ID %s", last_sync_id)
 
     try:
-        antholume_conn = get_antholume_connection()
-        antholume_cursor = antholume_conn.cursor()
+        antholume = session.antholume_reader()
 
-        booklore_conn = get_booklore_connection()
+        booklore_conn = session.booklore_connection()
         booklore_cursor = booklore_conn.cursor()
 
-        # Load BookLore books cache
-        load_booklore_books(booklore_cursor)
+        # Load BookLore books cache (the scheduler does this once for all sources)
+        if refresh:
+            with stats.timed('load'):
+                refresh_booklore_books(booklore_cursor)
+        if get_source().newest_session_start is None and start_http_server is not None:
+            load_newest_session(booklore_cursor)
 
-        # Get new activities with document info
-        antholume_cursor.execute("""
-            SELECT a.id, a.document_id, a.start_time, a.duration,
-                   a.start_percentage, a.end_percentage,
-                   d.title, d.author, d.md5, d.filepath, d.id as doc_id
-            FROM activity a
-            JOIN documents d ON a.document_id = d.id
-            WHERE a.id > ?
-            ORDER BY a.id ASC
-        """, (last_sync_id,))
+        activity_count = 0
+        synced_count = 0
 
-        activities = antholume_cursor.fetchall()
-        print(f"[{datetime.now()}] Found {len(activities)} new activities")
+        # Each chunk is committed to BookLore and checkpointed on its own, so a
+        # crash mid-backfill resumes after the last finished chunk
+        for activities in antholume.iter_activities(last_sync_id):
+            activity_count += len(activities)
+            synced_count += sync_activity_chunk(booklore_cursor, activities, resolved)
+            booklore_conn.commit()
+            get_match_cache().commit()
+            save_last_sync_id(activities[-1][0])
 
-        synced_count = 0
-        max_id = last_sync_id
+        # Ends the read snapshot even when nothing was written
+        booklore_conn.commit()
+        stats.count('activities', activity_count)
+        stats.count('sessions_synced', synced_count)
+        log.debug("Activity sync complete: %d sessions synced from %d new activities",
+                  synced_count, activity_count)
 
-        for activity in activities:
-            (activity_id, document_id, start_time, duration,
-             start_percentage, end_percentage, title, author, md5, filepath, doc_id) = activity
+    except Exception as e:
+        session.reset()
+        stats.count('errors')
+        log.exception("Activity sync error: %s", e)
+
+
+class ProgressWatermarks:
+    """Fingerprint of each (document, device) progress row as of its last successful sync"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS progress_seen (
+                document_id TEXT NOT NULL,
+                device_id TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                PRIMARY KEY (document_id, device_id)
+            )
+        """)
+        self.conn.commit()
+        self.seen = {
+            (document_id, device_id): fingerprint
+            for document_id, device_id, fingerprint in self.conn.execute(
+                "SELECT document_id, device_id, fingerprint FROM progress_seen")
+        }
+        self.pending = {}
 
-            max_id = max(max_id, activity_id)
+    def changed(self, document_id, device_id, fingerprint):
+        return self.seen.get((document_id, device_id or '')) != fingerprint
 
-            antholume_doc = {
-                'id': doc_id,
-                'title': title,
-                'author': author,
-                'md5': md5,
-                'filepath': filepath
-            }
+    def mark(self, document_id, device_id, fingerprint):
+        """Record a processed row; takes effect on commit()"""
+        self.pending[(document_id, device_id or '')] = fingerprint
 
-            book_id = find_booklore_book(antholume_doc)
+    def commit(self):
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO progress_seen (document_id, device_id, fingerprint)
+            VALUES (?, ?, ?)
+        """, [(*key, fingerprint) for key, fingerprint in self.pending.items()])
+        self.conn.commit()
+        self.seen.update(self.pending)
+        self.pending = {}
 
-            if not book_id:
-                print(f"[{datetime.now()}] No match for: '{title or doc_id}' by '{author or 'Unknown'}'")
-                continue
+    def discard(self):
+        self.pending = {}
 
-            # Parse start_time
-            try:
-                if isinstance(start_time, str):
-                    if 'T' in start_time:
-                        start_dt = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-                    else:
-                        start_dt = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
-                else:
-                    start_dt = datetime.fromtimestamp(start_time)
-            except:
-                start_dt = datetime.now()
-
-            # Calculate end time
-            duration_secs = int(duration or 0)
-            end_dt = start_dt + timedelta(seconds=duration_secs)
-
-            # Calculate progress
-            start_pct = float(start_percentage or 0) * 100
-            end_pct = float(end_percentage or 0) * 100
-            progress_delta = end_pct - start_pct
-
-            book_type = get_book_type(title, filepath)
-
-            # Check for duplicate
-            booklore_cursor.execute("""
-                SELECT id FROM reading_sessions
-                WHERE user_id = %s AND book_id = %s
-                  AND ABS(TIMESTAMPDIFF(SECOND, start_time, %s)) < 60
-                LIMIT 1
-            """, (BOOKLORE_USER_ID, book_id, start_dt))
-
-            if booklore_cursor.fetchone():
-                continue
 
-            # Insert reading session
-            booklore_cursor.execute("""
-                INSERT INTO reading_sessions
-                (user_id, book_id, book_type, start_time, end_time, duration_seconds,
-                 start_progress, end_progress, progress_delta, start_location, end_location, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
-            """, (
-                BOOKLORE_USER_ID, book_id, book_type, start_dt, end_dt, duration_secs,
-                start_pct, end_pct, progress_delta,
-                f'antholume:{document_id}', f'antholume:{document_id}'
-            ))
-
-            synced_count += 1
-            book_title = book_cache.get(book_id, {}).get('title', 'Unknown')
-            print(f"[{datetime.now()}] Synced: '{book_title}' - {duration_secs}s, {progress_delta:.1f}% progress")
+def get_progress_watermarks():
+    source = get_source()
+    if source.progress_watermarks is None:
+        source.progress_watermarks = ProgressWatermarks(source.progress_state_file)
+    return source.progress_watermarks
 
-        booklore_conn.commit()
 
-        if max_id > last_sync_id:
-            save_last_sync_id(max_id)
+def progress_fingerprint(percentage, progress_str, book_id):
+    """Hash of a document_progress row plus the BookLore book its document resolved to"""
+    return hashlib.sha1(f'{percentage!r}\x1f{progress_str}\x1f{book_id}'.encode('utf-8')).hexdigest()
 
-        print(f"[{datetime.now()}] Activity sync complete: {synced_count} sessions synced")
 
-        antholume_conn.close()
-        booklore_conn.close()
+def read_status_for(progress_percent):
+    """read_status implied by a KOReader progress fraction, None to keep the current one"""
+    if progress_percent >= 0.95:
+        return 'READ'
+    if progress_percent > 0:
+        return 'READING'
+    return None
 
-    except Exception as e:
-        print(f"[{datetime.now()}] Activity sync error: {e}")
-        import traceback
-        traceback.print_exc()
+
+def prefetch_book_progress(cursor):
+    """Current KOReader progress of every book of the source's BookLore user"""
+    cursor.execute("""
+        SELECT book_id, koreader_progress_percent FROM user_book_progress
+        WHERE user_id = %s
+    """, (get_source().user_id,))
+    return {row['book_id']: float(row['koreader_progress_percent'] or 0) for row in cursor.fetchall()}
+
+
+def upsert_book_progress(cursor, rows):
+    """Bulk INSERT ... ON DUPLICATE KEY UPDATE of user_book_progress rows"""
+    user_id = get_source().user_id
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        now = server_now(cursor)
+        cursor.executemany("""
+            INSERT INTO user_book_progress
+            (user_id, book_id, koreader_progress, koreader_progress_percent,
+             koreader_device, koreader_device_id, koreader_last_sync_time,
+             last_read_time, read_status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                koreader_progress = VALUES(koreader_progress),
+                koreader_progress_percent = VALUES(koreader_progress_percent),
+                koreader_device = VALUES(koreader_device),
+                koreader_device_id = VALUES(koreader_device_id),
+                koreader_last_sync_time = VALUES(koreader_last_sync_time),
+                last_read_time = VALUES(last_read_time),
+                read_status = COALESCE(VALUES(read_status), read_status)
+        """, [
+            (user_id, book_id, progress_str, progress_percent,
+             'AnthoLume', device_id, now, now, read_status)
+            for book_id, progress_str, progress_percent, device_id, read_status in rows[i:i + INSERT_BATCH_SIZE]
+        ])
+
+
+def plan_progress(cursor, records, resolved, use_cache=True):
+    """
+    Work out the user_book_progress upserts for (document_id, percentage,
+    progress_str, device_id, antholume_doc) records without writing anything.
+    Returns (changes, decisions): upsert rows by book_id, and a (book_id, action)
+    per record with action 'insert', 'update', 'skip' or None when unmatched.
+    """
+    # Documents the activity sync already matched this cycle are reused
+    resolve_documents(resolved, {record[0]: record[4] for record in records}, use_cache)
+
+    # Current BookLore state, updated in place as changes are planned so that
+    # several AnthoLume rows for one book behave like sequential writes
+    current = prefetch_book_progress(cursor) if records else {}
+    changes = {}
+    decisions = []
+
+    for document_id, percentage, progress_str, device_id, antholume_doc in records:
+        book_id = resolved[document_id][0]
+        if not book_id:
+            decisions.append((None, None))
+            continue
+
+        # BookLore expects decimal (0.0-1.0), not percentage (0-100)
+        progress_percent = float(percentage or 0)
+
+        if book_id in current:
+            # Only update if progress is higher or significantly different
+            current_pct = current[book_id]
+            if not (progress_percent > current_pct or abs(progress_percent - current_pct) > 1):
+                decisions.append((book_id, 'skip'))
+                continue
+            # None keeps whatever read_status the row already has
+            pending_status = changes[book_id][4] if book_id in changes else None
+            read_status = read_status_for(progress_percent) or pending_status
+            action = 'update'
+        else:
+            # New progress row
+            read_status = read_status_for(progress_percent) or 'UNREAD'
+            action = 'insert'
+
+        current[book_id] = progress_percent
+        changes[book_id] = (book_id, progress_str, progress_percent, device_id, read_status)
+        decisions.append((book_id, action))
+
+    return changes, decisions
 
 
-def sync_progress():
+def sync_progress(session, resolved):
     """Sync current reading progress from AnthoLume to BookLore"""
-    print(f"[{datetime.now()}] Starting progress sync...")
+    log.debug("Starting progress sync...")
 
     try:
-        antholume_conn = get_antholume_connection()
-        antholume_cursor = antholume_conn.cursor()
+        antholume = session.antholume_reader()
 
-        booklore_conn = get_booklore_connection()
+        booklore_conn = session.booklore_connection()
         booklore_cursor = booklore_conn.cursor()
 
         # Ensure cache is loaded
-        if not book_cache:
+        if book_index is None:
             load_booklore_books(booklore_cursor)
 
-        # Get document progress with full document info
-        antholume_cursor.execute("""
-            SELECT dp.document_id, dp.percentage, dp.progress, dp.device_id,
-                   d.title, d.author, d.md5, d.filepath, d.id as doc_id
-            FROM document_progress dp
-            JOIN documents d ON dp.document_id = d.id
-        """)
-
-        progress_records = antholume_cursor.fetchall()
         updated_count = 0
 
-        for record in progress_records:
-            (document_id, percentage, progress_str, device_id,
-             title, author, md5, filepath, doc_id) = record
-
-            antholume_doc = {
-                'id': doc_id,
-                'title': title,
-                'author': author,
-                'md5': md5,
-                'filepath': filepath
-            }
-
-            book_id = find_booklore_book(antholume_doc)
-
-            if not book_id:
-                continue
-
-            # BookLore expects decimal (0.0-1.0), not percentage (0-100)
-            progress_percent = float(percentage or 0)
-
-            # Check if progress exists
-            booklore_cursor.execute("""
-                SELECT id, koreader_progress_percent FROM user_book_progress
-                WHERE user_id = %s AND book_id = %s
-            """, (BOOKLORE_USER_ID, book_id))
-
-            existing = booklore_cursor.fetchone()
-
-            if existing:
-                # Only update if progress is higher or significantly different
-                current_pct = float(existing.get('koreader_progress_percent') or 0)
-                if progress_percent > current_pct or abs(progress_percent - current_pct) > 1:
-                    booklore_cursor.execute("""
-                        UPDATE user_book_progress
-                        SET koreader_progress = %s,
-                            koreader_progress_percent = %s,
-                            koreader_device = %s,
-                            koreader_device_id = %s,
-                            koreader_last_sync_time = NOW(),
-                            last_read_time = NOW(),
-                            read_status = CASE WHEN %s >= 0.95 THEN 'READ'
-                                              WHEN %s > 0 THEN 'READING'
-                                              ELSE read_status END
-                        WHERE user_id = %s AND book_id = %s
-                    """, (progress_str, progress_percent, 'AnthoLume', device_id,
-                          progress_percent, progress_percent, BOOKLORE_USER_ID, book_id))
-                    updated_count += 1
-            else:
-                # Insert new progress
-                read_status = 'READ' if progress_percent >= 0.95 else 'READING' if progress_percent > 0 else 'UNREAD'
-                booklore_cursor.execute("""
-                    INSERT INTO user_book_progress
-                    (user_id, book_id, koreader_progress, koreader_progress_percent,
-                     koreader_device, koreader_device_id, koreader_last_sync_time,
-                     last_read_time, read_status)
-                    VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW(), %s)
-                """, (BOOKLORE_USER_ID, book_id, progress_str, progress_percent,
-                      'AnthoLume', device_id, read_status))
+        # Only matched rows that changed, or whose document now resolves to
+        # another book, since they were last synced. Resolving mostly hits the
+        # match cache. Unmatched rows are left out and stay unmarked, so they
+        # sync once their book shows up.
+        watermarks = get_progress_watermarks()
+        changed_records = []
+        for chunk in antholume.iter_progress():
+            records = []
+            for (document_id, percentage, progress_str, device_id,
+                 title, author, md5, filepath, doc_id) in chunk:
+                antholume_doc = {
+                    'id': doc_id,
+                    'title': title,
+                    'author': author,
+                    'md5': md5,
+                    'filepath': filepath
+                }
+                records.append((document_id, percentage, progress_str, device_id, antholume_doc))
+            resolve_documents(resolved, {record[0]: record[4] for record in records})
+
+            for record in records:
+                book_id = resolved[record[0]][0]
+                if not book_id:
+                    continue
+                fingerprint = progress_fingerprint(record[1], record[2], book_id)
+                if watermarks.changed(record[0], record[3], fingerprint):
+                    changed_records.append((*record, fingerprint))
+
+        changes, decisions = plan_progress(booklore_cursor, [record[:5] for record in changed_records], resolved)
+
+        for record, (_, action) in zip(changed_records, decisions):
+            watermarks.mark(record[0], record[3], record[5])
+            if action in ('insert', 'update'):
                 updated_count += 1
 
-        booklore_conn.commit()
-        print(f"[{datetime.now()}] Progress sync complete: {updated_count} books updated")
+        upsert_book_progress(booklore_cursor, list(changes.values()))
 
-        antholume_conn.close()
-        booklore_conn.close()
+        booklore_conn.commit()
+        watermarks.commit()
+        get_match_cache().commit()
+        get_cycle_stats().count('progress_changed', len(changed_records))
+        get_cycle_stats().count('progress_applied', updated_count)
+        log.debug("Progress sync complete: %d of %d changed rows applied", updated_count, len(changed_records))
 
     except Exception as e:
-        print(f"[{datetime.now()}] Progress sync error: {e}")
-        import traceback
-        traceback.print_exc()
+        session.reset()
+        get_progress_watermarks().discard()
+        get_cycle_stats().count('errors')
+        log.exception("Progress sync error: %s", e)
+
+
+def write_plan(session, from_id, path):
+    """
+    Replay activities after from_id and every progress row through the read,
+    match and dedupe pipeline and write what a sync would change to path as
+    JSONL. Matching ignores the match cache; nothing is written to BookLore,
+    the watermark or the match and progress state.
+    """
+    cycle_stats = get_source().stats = CycleStats()
+    antholume = session.antholume_reader()
+    booklore_conn = session.booklore_connection()
+    booklore_cursor = booklore_conn.cursor()
+    with cycle_stats.timed('load'):
+        refresh_booklore_books(booklore_cursor)
+
+    resolved = {}
+    planned = defaultdict(list)
+    last_id = from_id
+
+    def match_line(document_id, antholume_doc):
+        book_id, book_type, method = resolved[document_id]
+        return {'type': 'match', 'document_id': document_id, 'title': antholume_doc['title'],
+                'author': antholume_doc['author'], 'book_id': book_id,
+                'book_title': book_cache[book_id].title if book_id else None,
+                'book_type': book_type, 'method': method}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as out:
+        def emit(record):
+            out.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+        for activities in antholume.iter_activities(from_id):
+            new_documents, sessions, skipped = plan_activity_chunk(
+                booklore_cursor, activities, resolved, use_cache=False, planned=planned)
+            for document_id, antholume_doc in new_documents.items():
+                emit(match_line(document_id, antholume_doc))
+            for activity_id, document_id, row in sessions:
+                emit({'type': 'session', 'activity_id': activity_id, 'document_id': document_id,
+                      'book_id': row[1], 'book_type': row[2],
+                      'start_time': row[3].isoformat(), 'end_time': row[4].isoformat(),
+                      'duration_seconds': row[5], 'start_progress': row[6], 'end_progress': row[7],
+                      'progress_delta': row[8]})
+            for activity_id, document_id, reason in skipped:
+                emit({'type': 'skip', 'activity_id': activity_id, 'document_id': document_id, 'reason': reason})
+            cycle_stats.count('activities', len(activities))
+            cycle_stats.count('sessions_planned', len(sessions))
+            last_id = activities[-1][0]
+
+        with cycle_stats.timed('progress'):
+            records = []
+            for chunk in antholume.iter_progress():
+                for document_id, percentage, progress_str, device_id, title, author, md5, filepath, doc_id in chunk:
+                    antholume_doc = {'id': doc_id, 'title': title, 'author': author, 'md5': md5, 'filepath': filepath}
+                    records.append((document_id, percentage, progress_str, device_id, antholume_doc))
+            seen = set(resolved)
+            changes, decisions = plan_progress(booklore_cursor, records, resolved, use_cache=False)
+
+        for (document_id, percentage, progress_str, device_id, antholume_doc), (book_id, action) in zip(records, decisions):
+            if document_id not in seen:
+                seen.add(document_id)
+                emit(match_line(document_id, antholume_doc))
+            emit({'type': 'progress', 'action': action or 'unmatched', 'document_id': document_id,
+                  'device_id': device_id, 'book_id': book_id, 'percent': float(percentage or 0)})
+        # The user_book_progress rows the sync would upsert
+        for book_id, progress_str, progress_percent, device_id, read_status in changes.values():
+            emit({'type': 'upsert', 'book_id': book_id, 'progress': progress_str, 'percent': progress_percent,
+                  'device_id': device_id, 'read_status': read_status})
+        cycle_stats.count('progress_rows', len(records))
+        cycle_stats.count('progress_upserts', len(changes))
+
+        emit({'type': 'summary', 'from_id': from_id, 'last_id': last_id,
+              **{name: n for name, n in cycle_stats.counts.items() if n}})
+    os.replace(tmp_path, path)
+
+    # Ends the read snapshot; nothing was written
+    booklore_conn.rollback()
+    log.info(cycle_stats.summary())
+    log.info("Plan written to %s", path)
+
+
+def source_signature():
+    """mtime/size of every source's antholume.db and WAL; changes whenever AnthoLume writes"""
+    signature = []
+    paths = [path for source in get_sources() for path in (source.antholume_db, source.antholume_db + '-wal')]
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def wait_for_source_change(since, timeout):
+    """
+    Block until an AnthoLume DB differs from `since` and they have been quiet for
+    WATCH_DEBOUNCE seconds, or until `timeout` seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    current = since
+    while time.monotonic() < deadline:
+        time.sleep(WATCH_POLL_INTERVAL)
+        latest = source_signature()
+        if latest != current:
+            current = latest
+            settle_at = time.monotonic() + WATCH_DEBOUNCE
+            while time.monotonic() < min(settle_at, deadline):
+                time.sleep(WATCH_POLL_INTERVAL)
+                latest = source_signature()
+                if latest != current:
+                    current = latest
+                    settle_at = time.monotonic() + WATCH_DEBOUNCE
+            log.debug("AnthoLume database changed")
+            return
+    log.debug("No AnthoLume changes in %s seconds", timeout)
+
+
+def run_cycle(session, refresh=True):
+    """One activity + progress sync of the current source over the session's shared connections"""
+    source = get_source()
+    stats = source.stats = CycleStats()
+    # document_id -> (book_id, book_type, method), shared by both phases of this cycle
+    resolved = {}
+    sync_activities(session, resolved, refresh)
+    with stats.timed('progress'):
+        sync_progress(session, resolved)
+    log.info("%s: %s", source.name, stats.summary())
+    record_cycle_metrics(session, stats)
+
+
+def run_source_cycle(source):
+    with using_source(source):
+        run_cycle(source.session, refresh=False)
+
+
+def run_round(pool):
+    """Refresh the shared catalogue once, then run every source's cycle concurrently"""
+    catalogue_session = get_sources()[0].session
+    stats = CycleStats()
+    try:
+        with stats.timed('load'):
+            booklore_conn = catalogue_session.booklore_connection()
+            refresh_booklore_books(booklore_conn.cursor())
+            booklore_conn.commit()
+            # Built here so concurrent cycles don't each build one, and the match
+            # workers are forked before the source threads start
+            get_vector_scorer()
+            if SYNC_WORKERS > 1:
+                get_match_pool()
+        log.info("catalogue: Refreshed %d books (load=%.2fs)", len(book_cache), stats.timings['load'])
+    except Exception as e:
+        catalogue_session.reset()
+        stats.count('errors')
+        log.exception("Catalogue refresh error: %s", e)
+        return
+    finally:
+        record_catalogue_metrics(stats)
+    # The index is only changed above, so cycles can share it while they run
+    list(pool.map(run_source_cycle, get_sources()))
+
+
+def record_cycle_metrics(session, stats):
+    """Publish a finished cycle's stats and the sync lag to Prometheus"""
+    if start_http_server is None:
+        return
+    source = get_source()
+    sync_cycle_duration.labels(source=source.name).observe(time.perf_counter() - stats.started)
+    for phase, seconds in stats.timings.items():
+        sync_phase_duration.labels(source=source.name, phase=phase).observe(seconds)
+    for method in ('md5', 'hash_prefix', 'fuzzy', 'miss'):
+        sync_matches.labels(source=source.name, method=method).inc(stats.counts[f'match_{method}'])
+    sync_matches.labels(source=source.name, method='cached').inc(stats.counts['match_cache_hits'])
+    sync_rows.labels(source=source.name, table='reading_sessions').inc(stats.counts['sessions_synced'])
+    sync_rows.labels(source=source.name, table='user_book_progress').inc(stats.counts['progress_applied'])
+    sync_duplicates.labels(source=source.name).inc(
+        stats.counts['duplicates_skipped'] + stats.counts['already_synced'])
+    sync_errors.labels(source=source.name).inc(stats.counts['errors'])
+    sync_last_sync_id.labels(source=source.name).set(get_last_sync_id())
+    sync_newest_session_age.labels(source=source.name).set_function(
+        lambda: time.time() - source.newest_session_start.timestamp()
+        if source.newest_session_start else float('nan'))
+    try:
+        sync_source_max_id.labels(source=source.name).set(session.antholume_reader().max_activity_id())
+    except Exception as e:
+        log.warning("Could not read AnthoLume max activity id: %s", e)
+
+
+def record_catalogue_metrics(stats):
+    """Publish the shared catalogue refresh under source="catalogue", as sources publish their load phase"""
+    if start_http_server is None:
+        return
+    sync_phase_duration.labels(source='catalogue', phase='load').observe(stats.timings['load'])
+    sync_errors.labels(source='catalogue').inc(stats.counts['errors'])
 
 
 def main():
+    logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL,
+                        format='[%(asctime)s] %(levelname)s %(message)s')
+
     print("=" * 60)
     print("AnthoLume to BookLore Sync Bridge")
     print("=" * 60)
-    print(f"AnthoLume DB: {ANTHOLUME_DB}")
+    for source in get_sources():
+        print(f"AnthoLume DB: {source.antholume_db} -> BookLore User ID: {source.user_id} ({source.name})")
     print(f"BookLore DB: {BOOKLORE_HOST}:{BOOKLORE_PORT}/{BOOKLORE_DB}")
+    print(f"Sync mode: {SYNC_MODE}")
     print(f"Sync interval: {SYNC_INTERVAL} seconds")
-    print(f"BookLore User ID: {BOOKLORE_USER_ID}")
+    print(f"Log level: {LOG_LEVEL}")
     print("=" * 60)
 
-    while True:
-        sync_activities()
-        sync_progress()
-        print(f"[{datetime.now()}] Sleeping for {SYNC_INTERVAL} seconds...")
-        time.sleep(SYNC_INTERVAL)
+    if SYNC_MODE == 'plan':
+        for source in get_sources():
+            with using_source(source), source.session:
+                path = PLAN_FILE
+                if len(get_sources()) > 1:
+                    root, ext = os.path.splitext(PLAN_FILE)
+                    path = f'{root}.{source.name}{ext}'
+                from_id = int(PLAN_FROM_ID) if PLAN_FROM_ID is not None else get_last_sync_id()
+                write_plan(source.session, from_id, path)
+        return
+
+    if start_http_server is not None and METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        log.info("Metrics available at http://0.0.0.0:%d/metrics", METRICS_PORT)
+
+    try:
+        with ThreadPoolExecutor(len(get_sources()), thread_name_prefix='source') as pool:
+            while True:
+                # Taken before syncing so writes made during the cycle trigger the next one
+                signature = source_signature()
+                run_round(pool)
+                if SYNC_MODE == 'watch':
+                    log.debug("Waiting for AnthoLume changes (at most %s seconds)...", SYNC_INTERVAL)
+                    wait_for_source_change(signature, SYNC_INTERVAL)
+                else:
+                    log.debug("Sleeping for %s seconds...", SYNC_INTERVAL)
+                    time.sleep(SYNC_INTERVAL)
+    finally:
+        close_match_pool()
+        for source in get_sources():
+            source.session.close()
 
 
 if __name__ == '__main__':